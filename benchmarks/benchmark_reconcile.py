@@ -0,0 +1,482 @@
+# Offline benchmark of the reconcile loop. A fake GitHub API is served locally, the Kubernetes API is replaced
+# with in-memory fakes and a synthetic yaml repo is generated with git, so no cluster or GitHub account is needed.
+#
+#   python benchmarks/benchmark_reconcile.py --folders 10 --manifests 6 --packages 20 --commits 40
+#
+# Each scenario reports wall time, peak memory (tracemalloc) and the number of GitHub and Kubernetes API calls.
+# Only the server-side apply engine is benchmarked, the job engine needs a real cluster to run its Jobs.
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from git import Repo
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+
+user_account = 'benchmark'
+repo_name = 'yamlrepo'
+folder_name = 'deploy'
+custom_container_prefix = 'doris'
+
+github_calls = Counter()
+kube_calls = Counter()
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# synthetic yaml repo
+
+def app_name(folder_number, manifest_number):
+    return f'app{folder_number}x{manifest_number}'
+
+def configmap_manifest(name, revision):
+    return (f'apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: {name}-config\n  namespace: bench\n'
+            f'data:\n  revision: "{revision}"\n  setting: "{name}"\n')
+
+def service_manifest(name):
+    return (f'apiVersion: v1\nkind: Service\nmetadata:\n  name: {name}\n  namespace: bench\n  labels:\n    app: {name}\n'
+            f'spec:\n  selector:\n    app: {name}\n  ports:\n  - port: 80\n')
+
+def workload_manifest(name, revision, kind):
+    service_name = f'  serviceName: {name}\n' if kind == 'StatefulSet' else ''
+    return (f'apiVersion: apps/v1\nkind: {kind}\nmetadata:\n  name: {name}\n  namespace: bench\n  labels:\n    app: {name}\n'
+            f'spec:\n{service_name}  replicas: 1\n  selector:\n    matchLabels:\n      app: {name}\n  template:\n    metadata:\n'
+            f'      labels:\n        app: {name}\n      annotations:\n        revision: "{revision}"\n    spec:\n'
+            f'      imagePullSecrets:\n      - name: ghcr\n      containers:\n      - name: {name}\n        image: image_url_var\n'
+            f'        envFrom:\n        - configMapRef:\n            name: {name}-config\n')
+
+def manifest_files(folders, manifests):
+    # path in the repo -> (app name, kind). Every app gets a configmap, a service and a workload, so manifests
+    # is rounded up to a multiple of 3. Every other app is a statefulset so both rollout status waits are run
+    files = {}
+    for folder_number in range(2, folders + 2):
+        folder = f'{folder_name}/{folder_number}-group{folder_number}'
+        for manifest_number in range(max(1, (manifests + 2) // 3)):
+            name = app_name(folder_number, manifest_number)
+            files[f'{folder}/50-{name}configmap.yml'] = (name, 'configmap')
+            files[f'{folder}/100-{name}service.yml'] = (name, 'service')
+            workload_kind = 'statefulset' if manifest_number % 2 else 'deployment'
+            files[f'{folder}/170-{name}{workload_kind}.yml'] = (name, workload_kind)
+    return files
+
+def write_manifest(repo_dir, path, name, kind, revision):
+    if kind == 'configmap':
+        text = configmap_manifest(name, revision)
+    elif kind == 'service':
+        text = service_manifest(name)
+    elif kind == 'statefulset':
+        text = workload_manifest(name, revision, 'StatefulSet')
+    else:
+        text = workload_manifest(name, revision, 'Deployment')
+    full_path = os.path.join(repo_dir, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'w') as file:
+        file.write(text)
+
+def create_origin_repo(origin_dir, files):
+    repo = Repo.init(origin_dir, initial_branch='main')
+    with repo.config_writer() as git_config:
+        git_config.set_value('user', 'name', 'benchmark')
+        git_config.set_value('user', 'email', 'benchmark@example.com')
+    for path, (name, kind) in files.items():
+        write_manifest(origin_dir, path, name, kind, 0)
+    repo.git.add(A=True)
+    repo.index.commit('initial manifests')
+    return repo
+
+def add_commits(repo, files, commits, files_per_commit, seed):
+    # every commit changes a few configmaps and workloads so both the direct applies and the configmap fan-out run
+    rng = random.Random(seed)
+    changeable = sorted(path for path, (name, kind) in files.items() if kind != 'service')
+    revisions = Counter()
+    for commit_number in range(commits):
+        for path in rng.sample(changeable, min(files_per_commit, len(changeable))):
+            revisions[path] += 1
+            name, kind = files[path]
+            write_manifest(repo.working_tree_dir, path, name, kind, revisions[path])
+        repo.git.add(A=True)
+        repo.index.commit(f'change {commit_number}')
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# fake GitHub API
+
+class FakeGitHub:
+
+    def __init__(self, origin_repo, packages):
+        self.origin_repo = origin_repo
+        self.lock = threading.Lock()
+        self.packages = {}
+        for package_number in range(packages):
+            self.packages[f'{custom_container_prefix}-{package_number}'] = {'id': 10_000_000_000 + package_number, 'version': 0}
+        self.packages['pipelineinitialisation'] = {'id': 20_000_000_000, 'version': 0}
+
+    def package_names(self, folders, manifests):
+        # packages are named after the apps so resolve_image_url finds them
+        names = [app_name(folder_number, manifest_number) for folder_number in range(2, folders + 2)
+                 for manifest_number in range(max(1, (manifests + 2) // 3))]
+        renamed = {}
+        for package_number, package in enumerate(self.packages.items()):
+            ghcr_name, package_state = package
+            if ghcr_name != 'pipelineinitialisation' and package_number < len(names):
+                ghcr_name = f'{custom_container_prefix}-{names[package_number]}'
+            renamed[ghcr_name] = package_state
+        self.packages = renamed
+
+    def bump_packages(self, count, seed):
+        with self.lock:
+            for ghcr_name in random.Random(seed).sample(sorted(self.packages), min(count, len(self.packages))):
+                self.packages[ghcr_name]['version'] += 1
+
+    def digest(self, ghcr_name):
+        return 'sha256:' + hashlib.sha256(f'{ghcr_name}-{self.packages[ghcr_name]["version"]}'.encode()).hexdigest()
+
+    def respond(self, path, query):
+        # returns (endpoint name, json body) for a request, body None for a 404
+        parts = path.strip('/').split('/')
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', ['30'])[0])
+        if parts[:1] == ['users'] and parts[2:] == ['packages']:
+            with self.lock:
+                items = [{'name': name, 'id': package['id']} for name, package in sorted(self.packages.items())]
+            return 'packages', items, page, per_page
+        if parts[:3] == ['user', 'packages', 'container'] and parts[4:] == ['versions']:
+            with self.lock:
+                if parts[3] not in self.packages:
+                    return 'versions', None, 1, per_page
+                return 'versions', [{'name': self.digest(parts[3])}], 1, per_page
+        if parts[:1] == ['repos'] and parts[3:] == ['commits']:
+            with self.lock:
+                items = [{'sha': commit.hexsha} for commit in self.origin_repo.iter_commits('main')]
+            return 'commits', items, page, per_page
+        if parts[:1] == ['repos'] and parts[3:4] in (['commits'], ['compare']):
+            with self.lock:
+                if parts[3] == 'compare':
+                    base, head = parts[4].split('...')
+                else:
+                    head = parts[4]
+                    base = self.origin_repo.commit(head).parents[0].hexsha
+                files = [{'filename': diff.b_path or diff.a_path, 'status': {'A': 'added', 'D': 'removed'}.get(diff.change_type, 'modified')}
+                         for diff in self.origin_repo.commit(base).diff(head)]
+            return parts[3], {'files': files}, 1, per_page
+        return 'unknown', None, 1, per_page
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    github = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        endpoint, body, page, per_page = self.github.respond(url.path, query)
+        next_url = None
+        if isinstance(body, list) and endpoint != 'versions':
+            if len(body) > page * per_page:
+                next_query = '&'.join(f'{key}={values[0]}' for key, values in query.items() if key != 'page')
+                next_url = f'http://{self.headers["Host"]}{url.path}?{next_query}&page={page + 1}'
+            body = body[(page - 1) * per_page:page * per_page]
+        if body is None:
+            github_calls[(endpoint, 404)] += 1
+            self.send_response(404)
+            self.end_headers()
+            return
+        payload = json.dumps(body).encode()
+        etag = '"' + hashlib.sha256(payload).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            github_calls[(endpoint, 304)] += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.rate_limit_headers()
+            self.end_headers()
+            return
+        github_calls[(endpoint, 200)] += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('ETag', etag)
+        if next_url:
+            self.send_header('Link', f'<{next_url}>; rel="next"')
+        self.rate_limit_headers()
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def rate_limit_headers(self):
+        self.send_header('X-RateLimit-Remaining', '5000')
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+
+    def log_message(self, format, *args):
+        pass
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# fake Kubernetes API
+
+def not_found():
+    return ApiException(status=404, reason='Not Found')
+
+class FakeCoreV1Api:
+
+    def __init__(self):
+        self.configmaps = {}
+        self.resource_version = 0
+
+    def next_resource_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def read_namespaced_config_map(self, name, namespace):
+        kube_calls['read configmap'] += 1
+        if (namespace, name) not in self.configmaps:
+            raise not_found()
+        return self.configmaps[(namespace, name)]
+
+    def list_namespaced_config_map(self, namespace):
+        kube_calls['list configmaps'] += 1
+        return client.V1ConfigMapList(items=[configmap for key, configmap in self.configmaps.items() if key[0] == namespace])
+
+    def create_namespaced_config_map(self, namespace, body):
+        kube_calls['create configmap'] += 1
+        body.metadata.resource_version = self.next_resource_version()
+        self.configmaps[(namespace, body.metadata.name)] = body
+        return body
+
+    def patch_namespaced_config_map(self, name, namespace, body):
+        kube_calls['patch configmap'] += 1
+        stored = self.configmaps.get((namespace, name))
+        if stored is None:
+            raise not_found()
+        if body.metadata.resource_version and body.metadata.resource_version != stored.metadata.resource_version:
+            raise ApiException(status=409, reason='Conflict')
+        body.metadata.resource_version = self.next_resource_version()
+        self.configmaps[(namespace, name)] = body
+        return body
+
+    def delete_namespaced_config_map(self, name, namespace):
+        kube_calls['delete configmap'] += 1
+        if self.configmaps.pop((namespace, name), None) is None:
+            raise not_found()
+
+    def list_namespaced_pod(self, namespace, label_selector=None, **kwargs):
+        # every workload is ready straight away
+        kube_calls['list pods'] += 1
+        labels = dict(pair.split('=', 1) for pair in label_selector.split(',')) if label_selector else {}
+        pod = client.V1Pod(metadata=client.V1ObjectMeta(name=f'{labels.get("app", "pod")}-1', labels=labels),
+                           status=client.V1PodStatus(phase='Running'))
+        return client.V1PodList(items=[pod], metadata=client.V1ListMeta(resource_version='1'))
+
+class FakeAppsV1Api:
+    # every workload has finished rolling out straight away
+
+    def rolled_out_list(self, kind, field_selector):
+        kube_calls[f'list {kind}'] += 1
+        name = field_selector.split('=', 1)[1]
+        metadata = client.V1ObjectMeta(name=name, generation=1)
+        workload = types.SimpleNamespace(metadata=metadata, spec=types.SimpleNamespace(replicas=1), status=types.SimpleNamespace(
+            observed_generation=1, replicas=1, updated_replicas=1, ready_replicas=1,
+            desired_number_scheduled=1, updated_number_scheduled=1, number_ready=1))
+        return types.SimpleNamespace(items=[workload], metadata=client.V1ListMeta(resource_version='1'))
+
+    def list_namespaced_deployment(self, namespace, field_selector=None, **kwargs):
+        return self.rolled_out_list('Deployment', field_selector)
+
+    def list_namespaced_stateful_set(self, namespace, field_selector=None, **kwargs):
+        return self.rolled_out_list('StatefulSet', field_selector)
+
+    def list_namespaced_daemon_set(self, namespace, field_selector=None, **kwargs):
+        return self.rolled_out_list('DaemonSet', field_selector)
+
+def check_fake_apis():
+    # the fakes must only have methods the real clients have, or the benchmark passes where the real client fails
+    for fake_class, real_class in ((FakeCoreV1Api, client.CoreV1Api), (FakeAppsV1Api, client.AppsV1Api)):
+        for method_name in vars(fake_class):
+            if method_name.startswith(('list_', 'read_', 'create_', 'patch_', 'delete_')) and not hasattr(real_class, method_name):
+                raise AttributeError(f'{real_class.__name__} has no method {method_name}')
+
+class FakeResource:
+    cluster_kinds = {'Namespace', 'PersistentVolume', 'StorageClass', 'ClusterRole', 'ClusterRoleBinding'}
+
+    def __init__(self, kind, objects):
+        self.kind = kind
+        self.namespaced = kind not in self.cluster_kinds
+        self.objects = objects
+
+    def server_side_apply(self, body, name, namespace, field_manager, force_conflicts):
+        kube_calls[f'apply {self.kind}'] += 1
+        self.objects[(self.kind, namespace, name)] = body
+        return body
+
+    def delete(self, name, namespace, propagation_policy=None):
+        kube_calls[f'delete {self.kind}'] += 1
+        if self.objects.pop((self.kind, namespace, name), None) is None:
+            raise not_found()
+
+    def get(self, name, namespace):
+        kube_calls[f'get {self.kind}'] += 1
+        if (self.kind, namespace, name) not in self.objects:
+            raise not_found()
+        return self.objects[(self.kind, namespace, name)]
+
+class FakeResources:
+
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, api_version, kind):
+        return FakeResource(kind, self.objects)
+
+    def invalidate_cache(self):
+        pass
+
+class FakeDynamicClient:
+
+    def __init__(self):
+        self.resources = FakeResources()
+
+
+# ----------------------------------------------------------------------------------------------------------------
+# benchmark
+
+def measure(name, function, trace_memory):
+    github_before = Counter(github_calls)
+    kube_before = Counter(kube_calls)
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    function()
+    wall_time = time.perf_counter() - started
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    github_delta = github_calls - github_before
+    kube_delta = kube_calls - kube_before
+    return {
+        'scenario': name,
+        'wall_seconds': round(wall_time, 4),
+        'peak_memory_bytes': peak_memory,
+        'github_calls': sum(github_delta.values()),
+        'github_calls_by_endpoint': {f'{endpoint} {status}': count for (endpoint, status), count in sorted(github_delta.items())},
+        'kube_calls': sum(kube_delta.values()),
+        'kube_calls_by_operation': dict(sorted(kube_delta.items())),
+    }
+
+def run_phase(doris, phase):
+    # one half of reconcile() with the state read and written around it the same way
+    reconcile_state = doris.read_reconcile_state()
+    doris.manifest_hashes = reconcile_state.setdefault('manifests', {})
+    package_images = doris.build_package_images(reconcile_state)
+    try:
+        phase(reconcile_state, package_images)
+    finally:
+        doris.write_reconcile_state(reconcile_state)
+
+def print_results(results):
+    print(f'{"scenario":<28}{"wall (s)":>10}{"peak mem (KiB)":>16}{"GitHub calls":>14}{"kube calls":>12}')
+    for result in results:
+        peak_memory = '-' if result['peak_memory_bytes'] is None else f'{result["peak_memory_bytes"] / 1024:.0f}'
+        print(f'{result["scenario"]:<28}{result["wall_seconds"]:>10.3f}{peak_memory:>16}{result["github_calls"]:>14}{result["kube_calls"]:>12}')
+    for result in results:
+        print(f'\n{result["scenario"]}')
+        print(f'  GitHub: {result["github_calls_by_endpoint"]}')
+        print(f'  Kubernetes: {result["kube_calls_by_operation"]}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the reconcile loop against local GitHub and Kubernetes stand-ins')
+    parser.add_argument('--folders', type=int, default=5, help='deploy folders in the synthetic yaml repo')
+    parser.add_argument('--manifests', type=int, default=6, help='manifests per folder (a configmap, service and deployment or statefulset per app)')
+    parser.add_argument('--packages', type=int, default=10, help='container packages in the fake registry')
+    parser.add_argument('--commits', type=int, default=20, help='new commits to replay after the first deploy')
+    parser.add_argument('--files-per-commit', type=int, default=3, help='manifests changed by each new commit')
+    parser.add_argument('--package-updates', type=int, default=5, help='packages given a new version before the package check')
+    parser.add_argument('--replay-mode', choices=('replay', 'squash'), default='replay', help='commit-replay-mode to benchmark')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-tracemalloc', action='store_true', help="don't measure peak memory, tracemalloc slows everything down")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='doris-benchmark-')
+    server = None
+    try:
+        files = manifest_files(args.folders, args.manifests)
+        origin_repo = create_origin_repo(os.path.join(work_dir, 'origin'), files)
+
+        github = FakeGitHub(origin_repo, args.packages)
+        github.package_names(args.folders, args.manifests)
+        FakeGitHubHandler.github = github
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGitHubHandler)
+        threading.Thread(target=server.serve_forever, name='fake-github', daemon=True).start()
+
+        # the pipeline reads its settings when it is imported
+        pvc_dir = os.path.join(work_dir, 'pvc')
+        os.makedirs(pvc_dir)
+        os.environ.update({
+            'user-account': user_account,
+            'pvc-name': pvc_dir.lstrip('/'),
+            'repo-name': repo_name,
+            'folder-name': folder_name,
+            'custom-container-prefix': custom_container_prefix,
+            'github-api-url': f'http://127.0.0.1:{server.server_address[1]}',
+            'package-checker-token': 'benchmark',
+            'yaml-commit-checker-token': 'benchmark',
+            'clone-yaml-token': 'benchmark',
+            'pull-ghcr-image-token': 'benchmark',
+            'commit-replay-mode': args.replay_mode,
+            'log-level': args.log_level,
+            'readiness-timeout': '5',
+        })
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import pipelineinitialisation as doris
+        doris.setup_logging()
+
+        check_fake_apis()
+        core_v1 = FakeCoreV1Api()
+        apps_v1 = FakeAppsV1Api()
+        dynamic_client = FakeDynamicClient()
+        doris.get_core_v1_api = lambda: core_v1
+        doris.get_apps_v1_api = lambda: apps_v1
+        doris.get_dynamic_client = lambda: dynamic_client
+        # the pvc starts with a clone of the yaml repo, fetches then come from the local origin
+        Repo.clone_from(origin_repo.working_tree_dir, os.path.join(pvc_dir, repo_name))
+
+        trace_memory = not args.no_tracemalloc
+        results = [measure('first cycle (deploy all)', lambda: doris.reconcile({'packages', 'commits'}), trace_memory)]
+
+        github.bump_packages(args.package_updates, args.seed)
+        results.append(measure(f'container_versions ({args.package_updates} new)',
+                               lambda: run_phase(doris, doris.container_versions), trace_memory))
+
+        add_commits(origin_repo, files, args.commits, args.files_per_commit, args.seed)
+        results.append(measure(f'yamlcommitsha ({args.commits} commits)',
+                               lambda: run_phase(doris, doris.yamlcommitsha), trace_memory))
+
+        results.append(measure('idle cycle', lambda: doris.reconcile({'packages', 'commits'}), trace_memory))
+
+        github.bump_packages(args.package_updates, args.seed + 1)
+        add_commits(origin_repo, files, args.commits, args.files_per_commit, args.seed + 1)
+        results.append(measure('busy cycle', lambda: doris.reconcile({'packages', 'commits'}), trace_memory))
+
+        print_results(results)
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump({'settings': vars(args), 'results': results}, file, indent=2)
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
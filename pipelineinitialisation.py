@@ -1,5 +1,7 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import base64
 import numpy as np
 import random
 import string
@@ -7,10 +9,20 @@ import re
 from git import Repo
 import os
 import time
+import threading
+import concurrent.futures
+import contextlib
+import cProfile
+import logging
+import sys
+import uuid
+from collections import OrderedDict
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import yaml
-from yaml.composer import ComposerError
-from yaml.error import MarkedYAMLError
-from kubernetes import client, config
+from kubernetes import client, config, dynamic, watch
+from kubernetes.dynamic.exceptions import ResourceNotFoundError
 from kubernetes.client.rest import ApiException
 
 
@@ -19,329 +31,1408 @@ pvc_name = os.getenv('pvc-name')
 repo_name = os.getenv('repo-name')
 folder_name = os.getenv('folder-name')
 custom_container_prefix = os.getenv('custom-container-prefix')
+github_api_url = os.getenv('github-api-url', 'https://api.github.com')
+github_cache_file = os.getenv('github-cache-file', f'/{pvc_name}/github-cache.json')
+github_cache_max_entries = int(os.getenv('github-cache-max-entries', '500'))
+github_max_workers = int(os.getenv('github-max-workers', '8'))
+github_max_pages = int(os.getenv('github-max-pages', '10'))
+github_max_retries = int(os.getenv('github-max-retries', '3'))
+github_rate_limit_reserve = int(os.getenv('github-rate-limit-reserve', '100'))
+state_shard_max_bytes = int(os.getenv('state-shard-max-bytes', '900000'))
+manifest_cache_max_entries = int(os.getenv('manifest-cache-max-entries', '2000'))
+manifest_cache_max_bytes = int(os.getenv('manifest-cache-max-bytes', str(32 * 1024 * 1024)))
+readiness_timeout = int(os.getenv('readiness-timeout', '50'))
+readiness_workers = int(os.getenv('readiness-workers', '8'))
+apply_engine = os.getenv('apply-engine', 'server-side')
+delete_timeout = int(os.getenv('delete-timeout', '60'))
+deploy_concurrency = int(os.getenv('deploy-concurrency', '4'))
+# enough connections for every readiness watch and deploy thread at once, plus the main loop
+kube_connection_pool_size = int(os.getenv('kube-connection-pool-size', str(readiness_workers + deploy_concurrency + 1)))
+redeploy_strategy = os.getenv('redeploy-strategy', 'rolling')
+commit_replay_mode = os.getenv('commit-replay-mode', 'replay')
+job_batch_mode = os.getenv('job-batch-mode', 'false').lower() == 'true'
+job_batch_timeout = int(os.getenv('job-batch-timeout', '600'))
+poll_interval = int(os.getenv('poll-interval', '20'))
+poll_min_interval = int(os.getenv('poll-min-interval', '10'))
+poll_max_interval = int(os.getenv('poll-max-interval', '120'))
+poll_backoff = float(os.getenv('poll-backoff', '1.5'))
+poll_jitter = float(os.getenv('poll-jitter', '0.1'))
+webhook_port = os.getenv('webhook-port')
+webhook_secret = os.getenv('webhook-secret')
+metrics_port = os.getenv('metrics-port')
+log_level = os.getenv('log-level', 'INFO').upper()
+profile_cycle_file = os.getenv('profile-cycle-file')
+profile_cycle_number = int(os.getenv('profile-cycle-number', '1'))
+
+# Logs are one JSON object per line. Messages are only formatted if their level is enabled, so the per file and
+# per pod detail logged at debug costs next to nothing at the default level. Every line of a reconcile cycle
+# carries the same cycle id
+logger = logging.getLogger('doris')
+log_cycle_id = None
+
+
+class JsonLogFormatter(logging.Formatter):
+
+    def format(self, record):
+        log_entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), 'level': record.levelname.lower(),
+                     'message': record.getMessage(), 'thread': record.threadName}
+        if log_cycle_id is not None:
+            log_entry['cycle'] = log_cycle_id
+        for key in ('span', 'seconds'):
+            if hasattr(record, key):
+                log_entry[key] = getattr(record, key)
+        if record.exc_info:
+            log_entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(log_entry, default=str)
+
+def setup_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonLogFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(log_level)
+    logger.propagate = False
+    # warnings from the http clients, e.g. a full connection pool, are logged as JSON too
+    urllib3_logger = logging.getLogger('urllib3')
+    urllib3_logger.addHandler(handler)
+    urllib3_logger.setLevel(logging.WARNING)
+    urllib3_logger.propagate = False
+
+@contextlib.contextmanager
+def timing_span(span):
+    # logs how long a phase of the cycle took and adds it to the phase duration histogram
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - started
+        observe_histogram('doris_phase_duration_seconds', seconds, phase=span)
+        logger.info('%s took %.2fs', span, seconds, extra={'span': span, 'seconds': round(seconds, 3)})
+
+# kinds whose pods are created as soon as they are applied, so readiness can be waited on
+readiness_kinds = {'Pod', 'Deployment', 'StatefulSet', 'DaemonSet', 'ReplicaSet', 'Job'}
+readiness_executor = concurrent.futures.ThreadPoolExecutor(max_workers=readiness_workers, thread_name_prefix='readiness')
+
+# owner of the fields set by server-side apply
+field_manager = 'doris'
+
+# kinds whose pods can be rolled over by changing the pod template, and kinds that have to be deleted to be changed
+rolling_update_kinds = {'Deployment', 'StatefulSet', 'DaemonSet'}
+recreate_kinds = {'Pod', 'Job', 'ReplicaSet'}
+config_checksum_annotation = 'doris/config-checksum'
+
+# one ApiClient (and so one urllib3 connection pool) is shared by every API group
+# so keep-alive connections to the API server are reused between calls and cycles
+kube_api_client = None
+kube_api_client_lock = threading.Lock()
+kube_apis = {}
+kube_apis_lock = threading.Lock()
+
+
+def get_kube_api_client():
+    global kube_api_client
+    if kube_api_client is None:
+        with kube_api_client_lock:
+            if kube_api_client is None:
+                config.load_incluster_config()
+                configuration = client.Configuration.get_default_copy()
+                configuration.connection_pool_maxsize = kube_connection_pool_size
+                kube_api_client = client.ApiClient(configuration)
+                logger.info('Kubernetes API client created with connection pool size %s', kube_connection_pool_size)
+    return kube_api_client
+
+def get_kube_api(api_class):
+    api = kube_apis.get(api_class)
+    if api is None:
+        api_client = get_kube_api_client()
+        with kube_apis_lock: #deploy waves can ask for the same api from several threads
+            api = kube_apis.get(api_class)
+            if api is None:
+                api = api_class(api_client)
+                kube_apis[api_class] = api
+    return api
+
+def get_core_v1_api():
+    return get_kube_api(client.CoreV1Api)
+
+def get_batch_v1_api():
+    return get_kube_api(client.BatchV1Api)
+
+def get_apps_v1_api():
+    return get_kube_api(client.AppsV1Api)
+
+def get_dynamic_client():
+    # used for applying manifests of any kind, API discovery is done once and cached
+    return get_kube_api(dynamic.DynamicClient)
+
+
+# Prometheus metrics, kept in memory and served in the text exposition format on /metrics when metrics-port
+# is set. Values are keyed by metric name then by a sorted tuple of label pairs
+metric_descriptions = {
+    'doris_phase_duration_seconds': ('histogram', 'Time taken by each phase of the reconcile loop'),
+    'doris_github_request_duration_seconds': ('histogram', 'Time taken by GitHub API requests'),
+    'doris_github_requests_total': ('counter', 'GitHub API requests by endpoint and status code'),
+    'doris_github_rate_limit_remaining': ('gauge', 'GitHub API requests left before the rate limit resets'),
+    'doris_kube_apply_duration_seconds': ('histogram', 'Time taken to apply or delete one Kubernetes object'),
+    'doris_readiness_wait_seconds': ('histogram', 'Time spent waiting for the pods of a workload to be ready'),
+    'doris_manifest_operations_total': ('counter', 'Kubernetes objects applied, deleted and redeployed'),
+    'doris_manifests_skipped_total': ('counter', 'Manifest files not applied because they had not changed'),
+    'doris_apply_jobs_total': ('counter', 'Kubectl Jobs created to apply manifests'),
+    'doris_poll_interval_seconds': ('gauge', 'Current polling interval of each source'),
+    'doris_last_successful_sync_timestamp_seconds': ('gauge', 'Unix time each source was last checked against GitHub without errors'),
+    'doris_reconcile_queue_depth': ('gauge', 'Webhook triggered checks waiting to run'),
+    'doris_manifest_cache_entries': ('gauge', 'Parsed manifest files kept in memory'),
+    'doris_manifest_cache_requests_total': ('counter', 'Manifest cache hits and misses'),
+}
+metric_values = {name: {} for name in metric_descriptions}
+histogram_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+metrics_lock = threading.Lock()
+
+
+def metric_labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc_counter(name, amount=1, **labels):
+    with metrics_lock:
+        values = metric_values[name]
+        values[metric_labels(labels)] = values.get(metric_labels(labels), 0) + amount
+
+def set_gauge(name, value, **labels):
+    with metrics_lock:
+        metric_values[name][metric_labels(labels)] = value
+
+def observe_histogram(name, value, **labels):
+    # stored as [count per bucket..., sum, count], the buckets are cumulative like Prometheus expects
+    with metrics_lock:
+        histogram = metric_values[name].setdefault(metric_labels(labels), [0] * (len(histogram_buckets) + 2))
+        for bucket_number, bucket in enumerate(histogram_buckets):
+            if value <= bucket:
+                histogram[bucket_number] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def format_metric_labels(labels, extra_labels=()):
+    labels = labels + tuple(extra_labels)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+def render_metrics():
+    # values that are only read when scraped
+    set_gauge('doris_reconcile_queue_depth', len(reconcile_triggers))
+    set_gauge('doris_manifest_cache_entries', len(manifest_cache))
+    with metrics_lock:
+        metric_values['doris_manifest_cache_requests_total'][metric_labels({'result': 'hit'})] = manifest_cache_stats['hits']
+        metric_values['doris_manifest_cache_requests_total'][metric_labels({'result': 'miss'})] = manifest_cache_stats['misses']
+        lines = []
+        for name, (metric_type, help_text) in metric_descriptions.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in sorted(metric_values[name].items()):
+                if metric_type != 'histogram':
+                    lines.append(f'{name}{format_metric_labels(labels)} {value}')
+                    continue
+                for bucket_number, bucket in enumerate(histogram_buckets):
+                    lines.append(f'{name}_bucket{format_metric_labels(labels, [("le", str(bucket))])} {value[bucket_number]}')
+                lines.append(f'{name}_bucket{format_metric_labels(labels, [("le", "+Inf")])} {value[-1]}')
+                lines.append(f'{name}_sum{format_metric_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{format_metric_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+# ETag/Last-Modified of every GitHub response is kept with its parsed body, and saved to the pvc at the end
+# of each cycle it changed in so it survives restarts. Requests are conditional and a 304 reuses the stored body
+github_cache = None
+github_cache_dirty = False
+github_cache_lock = threading.Lock()
+
+# rate limit budget from the headers of the last GitHub response
+github_rate_limit = {'remaining': None, 'reset': 0}
+github_rate_limit_lock = threading.Lock()
+
+# keep-alive connections to GitHub are shared by all requests, including the parallel package lookups
+github_session = requests.Session()
+github_session.mount('https://', HTTPAdapter(pool_maxsize=github_max_workers))
+github_session.mount('http://', HTTPAdapter(pool_maxsize=github_max_workers))
+
+
+def github_headers(token):
+    return {
+    "Accept": "application/vnd.github+json",
+    "Authorization": f"Bearer {token}",
+    "X-GitHub-Api-Version": "2022-11-28"
+    }
 
-
-def get_configmaps():
-    config.load_incluster_config()
-    v1 = client.CoreV1Api()
-
+def load_github_cache():
+    global github_cache
+    if github_cache is None:
+        github_cache = {}
+        try:
+            with open(github_cache_file, 'r') as file:
+                github_cache = json.load(file)
+            logger.debug('Loaded %s cached GitHub responses', len(github_cache))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error('Error reading GitHub cache, starting with an empty one: %s', e)
+    return github_cache
+
+def save_github_cache():
+    # only written if a response was added since it was last saved
+    global github_cache_dirty
+    with github_cache_lock:
+        if not github_cache_dirty:
+            return
+        github_cache_dirty = False
+        cache_json = json.dumps(github_cache)
     try:
-        configmaps = v1.list_namespaced_config_map(namespace='admin')
+        temp_file = github_cache_file + '.tmp'
+        with open(temp_file, 'w') as file:
+            file.write(cache_json)
+        os.replace(temp_file, github_cache_file)
     except Exception as e:
-        print(f"Error: {e}")
-
-    configmaplist = []
-
-    for configmap in configmaps.items:
-        print('Configmap for loop')
-        print(configmap.metadata.name)
+        logger.error('Error saving GitHub cache: %s', e)
+
+def discard_github_cache():
+    # forgets the responses since the cache was last saved, it is read from the pvc again when next needed
+    global github_cache, github_cache_dirty
+    with github_cache_lock:
+        github_cache = None
+        github_cache_dirty = False
+
+def record_github_rate_limit(response):
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    reset = response.headers.get('X-RateLimit-Reset')
+    if remaining is not None and reset is not None:
+        with github_rate_limit_lock:
+            github_rate_limit['remaining'] = int(remaining)
+            github_rate_limit['reset'] = int(reset)
+        set_gauge('doris_github_rate_limit_remaining', int(remaining))
+
+def wait_for_github_rate_limit():
+    # once the remaining budget is low the requests left are spread out until the limit resets
+    with github_rate_limit_lock:
+        remaining = github_rate_limit['remaining']
+        reset = github_rate_limit['reset']
+        if remaining is not None and remaining <= github_rate_limit_reserve:
+            github_rate_limit['remaining'] = remaining - 1
+    seconds_to_reset = reset - time.time()
+    if remaining is None or remaining > github_rate_limit_reserve or seconds_to_reset <= 0:
+        return
+    delay = seconds_to_reset if remaining <= 0 else seconds_to_reset / remaining
+    logger.warning('GitHub rate limit has %s requests left, waiting %.1fs', remaining, delay)
+    time.sleep(delay)
+
+def github_retry_delay(response):
+    # seconds to wait before retrying a rate limited response, None if it wasn't rate limited
+    if response.status_code not in (403, 429):
+        return None
+    if response.headers.get('Retry-After'):
+        return int(response.headers['Retry-After'])
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        return max(1, int(response.headers.get('X-RateLimit-Reset', time.time())) - int(time.time()))
+    return None
+
+def github_endpoint(url):
+    # a low cardinality name for the metrics, e.g. /user/packages/container/<name>/versions -> versions
+    path = url.split('?', 1)[0]
+    if '/compare/' in path:
+        return 'compare'
+    if '/commits/' in path:
+        return 'commit'
+    return path.rstrip('/').rsplit('/', 1)[-1]
+
+def github_request(url, token):
+    # returns the parsed json, whether it changed since the last request for this url and the url of the next page
+    global github_cache_dirty
+    with github_cache_lock:
+        cached = load_github_cache().get(url)
+    headers = github_headers(token)
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    for attempt in range(github_max_retries + 1):
+        wait_for_github_rate_limit()
+        started = time.monotonic()
+        response = github_session.get(url, headers=headers)
+        observe_histogram('doris_github_request_duration_seconds', time.monotonic() - started, endpoint=github_endpoint(url))
+        inc_counter('doris_github_requests_total', endpoint=github_endpoint(url), status=response.status_code)
+        record_github_rate_limit(response)
+        retry_delay = github_retry_delay(response)
+        if retry_delay is None or attempt == github_max_retries:
+            break
+        logger.warning('GitHub rate limited %s, retrying in %ss', url, retry_delay)
+        time.sleep(retry_delay)
+
+    if response.status_code == 304 and cached is not None:
+        return cached['data'], False, cached.get('next')
+
+    json_data = json.loads(response.text)
+    next_url = response.links.get('next', {}).get('url')
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if response.status_code == 200 and (etag or last_modified):
+        with github_cache_lock:
+            cache = load_github_cache()
+            cache.pop(url, None)
+            cache[url] = {'etag': etag, 'last_modified': last_modified, 'data': json_data, 'next': next_url}
+            while len(cache) > github_cache_max_entries:
+                del cache[next(iter(cache))] #oldest response first
+            github_cache_dirty = True
+    return json_data, True, next_url
+
+def github_get(url, token):
+    # returns the parsed json and whether it changed since the last request for this url
+    json_data, modified, next_url = github_request(url, token)
+    return json_data, modified
+
+def github_pages(url, token):
+    # yields each page of a list endpoint and whether it changed, only fetching the next page when asked for it
+    page_count = 0
+    while url is not None and page_count < github_max_pages:
+        json_data, modified, url = github_request(url, token)
+        if not isinstance(json_data, list):
+            raise ValueError(f'GitHub returned {json_data}')
+        page_count += 1
+        yield json_data, modified
+    if url is not None:
+        logger.warning('Stopped after %s pages of GitHub results', github_max_pages)
+
+
+# All reconcile state (the deployed yaml commit sha and the id and image url of every package) is kept as
+# one compact json object in a single ConfigMap in the admin namespace. It is read once at the start of a
+# cycle and written once at the end, with the resourceVersion so a conflicting write is detected.
+# If it grows past state-shard-max-bytes the rest is spread over extra numbered ConfigMaps, named after a
+# hash of the state they hold so a write that loses a conflict can't overwrite the shards of the one that won
+state_configmap_name = 'doris-reconcile-state'
+
+
+def new_reconcile_state():
+    return {'yaml-sha': 'empty', 'packages': {}, 'manifests': {}, '_resource_version': None, '_stored': None, '_shards': 0, '_shard_id': None}
+
+def state_shard_name(shard_id, shard_number):
+    if shard_id is None:
+        return f'{state_configmap_name}-{shard_number}' #written before shards were named after their state
+    return f'{state_configmap_name}-{shard_id}-{shard_number}'
+
+def read_reconcile_state():
+    v1 = get_core_v1_api()
+    try:
+        configmap = v1.read_namespaced_config_map(name=state_configmap_name, namespace='admin')
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        return migrate_reconcile_state()
+
+    data = configmap.data or {}
+    shard_count = int(data.get('shards', '0'))
+    shard_id = data.get('shard-id') or None
+    state_json = data.get('state', '')
+    for shard_number in range(1, shard_count + 1):
+        shard = v1.read_namespaced_config_map(name=state_shard_name(shard_id, shard_number), namespace='admin')
+        state_json += (shard.data or {}).get('state', '')
+
+    reconcile_state = new_reconcile_state()
+    if state_json:
+        reconcile_state.update(json.loads(state_json))
+    reconcile_state['_resource_version'] = configmap.metadata.resource_version
+    reconcile_state['_stored'] = state_json
+    reconcile_state['_shards'] = shard_count
+    reconcile_state['_shard_id'] = shard_id
+    return reconcile_state
+
+def migrate_reconcile_state():
+    # moves the old containerlist-<package> and current-yaml-commit-sha ConfigMaps into the state ConfigMap
+    logger.info('No reconcile state found, creating it from existing configmaps')
+    v1 = get_core_v1_api()
+    reconcile_state = new_reconcile_state()
+    old_configmaps = []
+    for configmap in v1.list_namespaced_config_map(namespace='admin').items:
         configmapname = configmap.metadata.name
-        if 'containerlist' in configmapname:
-            configmaplist.append(configmapname)
+        data = configmap.data or {}
+        if configmapname == 'current-yaml-commit-sha':
+            reconcile_state['yaml-sha'] = data.get('yaml-sha', 'empty')
+        elif configmapname.startswith('containerlist-') and data:
+            package_id, image_url = next(iter(data.items()))
+            reconcile_state['packages'][configmapname[len('containerlist-'):]] = {'id': package_id, 'image': image_url}
         else:
-            print(f'Configmapname {configmapname} is not relevant')
-    return configmaplist
-
-def get_configmap_data(configmap_name):
-    config.load_incluster_config()
-    v1 = client.CoreV1Api()
-
+            continue
+        old_configmaps.append(configmapname)
+
+    write_reconcile_state(reconcile_state)
+    for configmapname in old_configmaps:
+        delete_configmap(configmapname)
+    return reconcile_state
+
+def write_state_configmap(v1, configmapname, data, resource_version=None, create=False):
+    metadata = client.V1ObjectMeta(namespace='admin', name=configmapname, resource_version=resource_version)
+    body = client.V1ConfigMap(api_version="v1", kind="ConfigMap", metadata=metadata, data=data)
+    if create:
+        return v1.create_namespaced_config_map('admin', body=body)
+    return v1.patch_namespaced_config_map(name=configmapname, namespace='admin', body=body)
+
+def write_state_shard(v1, shard_name, data, exists):
+    # a shard can be left over from a write that failed part way, so whichever of create or patch fails is retried as the other
     try:
-        configmap = v1.read_namespaced_config_map(name=configmap_name, namespace='admin')
-        data = configmap.data
-        print(f"Key-Value pairs in ConfigMap '{configmap_name}' in namespace admin:")
-        for key, value in data.items():
-            configmap_key = key
-            configmap_value = value
-
-        print(f"Key: {configmap_key}, Value: {configmap_value}")
-
-        return configmap_key, configmap_value
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
-
-def apply_configmap(configmapname, configmapkey, configmapvalue):
-    config.load_incluster_config()
-    if 'current-yaml-commit-sha' in configmapname:
-        configmapnamelabel = configmapname
-    else:
-        configmapnamelabel = 'containerlist-' + configmapname
-    api_instance = client.CoreV1Api()
-    config_map_manifest = client.V1ConfigMap(
-        api_version="v1",
-        kind="ConfigMap",
-        metadata=client.V1ObjectMeta(
-            namespace="admin",
-            name=configmapnamelabel
-        ),
-        data={
-            configmapkey: configmapvalue,
-        }
-    )
-
-    namespace = "admin"
-
-    try:     
-        api_instance.create_namespaced_config_map(namespace, body=config_map_manifest)
-        print(f"{configmapname} configmap created successfully.")
-
-    except Exception as e:
-        print(f"Error creating ConfigMap: {str(e)}")
-
-def update_configmap(configmap_name, key, value):
-    config.load_incluster_config()
-    v1 = client.CoreV1Api()
-
-    data = {key : value}
-
+        return write_state_configmap(v1, shard_name, data, create=not exists)
+    except ApiException as e:
+        if e.status not in (404, 409):
+            raise
+        return write_state_configmap(v1, shard_name, data, create=exists)
+
+def merge_reconcile_state(reconcile_state, current_state):
+    # applies what this cycle changed since the state was read on top of the state someone else has written since
+    original_state = new_reconcile_state()
+    if reconcile_state['_stored']:
+        original_state.update(json.loads(reconcile_state['_stored']))
+    for key in ('packages', 'manifests'):
+        merged = dict(current_state[key])
+        for name in reconcile_state[key].keys() | original_state[key].keys():
+            if name not in reconcile_state[key]:
+                if name in original_state[key]:
+                    merged.pop(name, None) #removed this cycle
+            elif reconcile_state[key][name] != original_state[key].get(name):
+                merged[name] = reconcile_state[key][name]
+        reconcile_state[key].clear() #updated in place as manifest_hashes points at 'manifests'
+        reconcile_state[key].update(merged)
+    if reconcile_state['yaml-sha'] == original_state['yaml-sha']:
+        reconcile_state['yaml-sha'] = current_state['yaml-sha']
+    for key in ('_resource_version', '_stored', '_shards', '_shard_id'):
+        reconcile_state[key] = current_state[key]
+
+def write_reconcile_state(reconcile_state, attempts=3):
+    state_json = json.dumps({key: value for key, value in reconcile_state.items() if not key.startswith('_')},
+                            sort_keys=True, separators=(',', ':'))
+    if state_json == reconcile_state['_stored']:
+        return
+    v1 = get_core_v1_api()
+
+    chunks = [state_json[start:start + state_shard_max_bytes] for start in range(0, len(state_json), state_shard_max_bytes)] or ['']
+    shard_count = len(chunks) - 1
+    shard_id = hashlib.sha256(state_json.encode()).hexdigest()[:12] if shard_count else None
+    for shard_number in range(1, shard_count + 1):
+        write_state_shard(v1, state_shard_name(shard_id, shard_number), {'state': chunks[shard_number]}, exists=False)
+
+    data = {'state': chunks[0], 'shards': str(shard_count), 'shard-id': shard_id or ''}
     try:
-        current_configmap = v1.read_namespaced_config_map(name=configmap_name, namespace='admin')
-        current_configmap.data = data
-
-        # Apply the changes
-        updated_configmap = v1.patch_namespaced_config_map(
-            name=configmap_name,
-            namespace='admin',
-            body=current_configmap
-        )
-
-        print(f"ConfigMap '{configmap_name}' in namespace admin updated successfully.")
-        return updated_configmap
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
-
+        if reconcile_state['_resource_version'] is None:
+            configmap = write_state_configmap(v1, state_configmap_name, data, create=True)
+        else:
+            configmap = write_state_configmap(v1, state_configmap_name, data, reconcile_state['_resource_version'])
+    except ApiException as e:
+        if e.status != 409 or attempts <= 1:
+            raise
+        # someone else changed the state since it was read, this cycle's changes are merged into theirs
+        logger.warning('Reconcile state changed since it was read, merging this cycle\'s changes into it')
+        current_state = read_reconcile_state()
+        if current_state['_shard_id'] != shard_id:
+            for shard_number in range(1, shard_count + 1):
+                delete_configmap(state_shard_name(shard_id, shard_number)) #nothing points at them
+        merge_reconcile_state(reconcile_state, current_state)
+        write_reconcile_state(reconcile_state, attempts - 1)
+        return
+
+    for shard_number in range(1, reconcile_state['_shards'] + 1):
+        if reconcile_state['_shard_id'] != shard_id or shard_number > shard_count:
+            delete_configmap(state_shard_name(reconcile_state['_shard_id'], shard_number))
+    reconcile_state['_resource_version'] = configmap.metadata.resource_version
+    reconcile_state['_stored'] = state_json
+    reconcile_state['_shards'] = shard_count
+    reconcile_state['_shard_id'] = shard_id
+    logger.debug('Reconcile state saved')
 
 def delete_configmap(configmap_name):
-    config.load_incluster_config()
-    v1 = client.CoreV1Api()
+    v1 = get_core_v1_api()
 
     try:
         v1.delete_namespaced_config_map(name=configmap_name, namespace='admin')
-        print(f"ConfigMap '{configmap_name}' deleted successfully'.")
+        logger.info("ConfigMap '%s' deleted successfully.", configmap_name)
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error('Error: %s', e)
 
 def get_namespaces():
-    config.load_incluster_config()
-    v1 = client.CoreV1Api()
+    v1 = get_core_v1_api()
     namespace_list = v1.list_namespace()
     # print('namespace_list is:', namespace_list)
     return namespace_list
 
 
-def pods_status(item_name, item_namespace):
-    print('Checking deployed pods')
-    config.load_incluster_config()
-    v1 = client.CoreV1Api()
-    status_counter = 0
-    print('item namespace is: ', item_namespace)
-    
-    while True:
-        pendingflag=False
-        pod_list = v1.list_namespaced_pod(item_namespace)
+def manifest_label_selector(yaml_data):
+    # pods of a workload carry its pod template labels, a bare pod carries its own labels
+    kind = yaml_data.get('kind')
+    spec = yaml_data.get('spec') or {}
+    if kind == 'Pod':
+        labels = yaml_data.get('metadata', {}).get('labels') or {}
+    else:
+        labels = (spec.get('selector') or {}).get('matchLabels') or {}
+        if not labels:
+            labels = spec.get('template', {}).get('metadata', {}).get('labels') or {}
+    if not labels:
+        return None
+    return ','.join(f'{key}={value}' for key, value in sorted(labels.items()))
+
+def pod_is_pending(pod):
+    return pod.status is not None and pod.status.phase == "Pending"
+
+def pods_status(item_name, item_namespace, label_selector=None, timeout=None):
+    # waits until at least one matching pod exists and none of them are still pending. The pods are always
+    # listed once, even with no time left. Returns True when ready and False if the timeout is reached first
+    logger.debug('Checking deployed pods')
+    v1 = get_core_v1_api()
+    if timeout is None:
+        timeout = readiness_timeout
+    deadline = time.monotonic() + timeout
+    logger.debug('item namespace is: %s', item_namespace)
+
+    def is_matching_pod(pod):
+        if pod.metadata.deletion_timestamp is not None:
+            return False #pods from a deleted version are terminating and don't count
+        if label_selector is None:
+            return item_name in pod.metadata.name
+        return True
 
+    while True:
+        pod_list = v1.list_namespaced_pod(item_namespace, label_selector=label_selector)
+        matching_pods = {}
         for pod in pod_list.items:
-            if item_name in pod.metadata.name:
-                pod_status = pod.status.phase
-                print(f'pod name is {pod.metadata.name} and status is {pod_status}')
-
-                if pod_status == "Pending" or pod_status == "ContainerCreating":
-                    pendingflag=True
-                    status_counter +=1
-                    time.sleep(1)
-                    print('There is a pod still being created')
-                    break
-                else:
-                    print('No pending pods')
-
-        if pendingflag != True or status_counter>=50:
-            print('No pending states found')
+            if is_matching_pod(pod):
+                matching_pods[pod.metadata.name] = pod_is_pending(pod)
+        if matching_pods and not any(matching_pods.values()):
+            logger.info('No pending pods for %s', item_name)
+            return True
+        if time.monotonic() >= deadline:
             break
 
+        pod_watch = watch.Watch()
+        try:
+            for event in pod_watch.stream(v1.list_namespaced_pod, item_namespace, label_selector=label_selector,
+                                          resource_version=pod_list.metadata.resource_version,
+                                          timeout_seconds=max(1, int(deadline - time.monotonic()))):
+                pod = event['object']
+                if event['type'] == 'DELETED' or not is_matching_pod(pod):
+                    matching_pods.pop(pod.metadata.name, None)
+                else:
+                    matching_pods[pod.metadata.name] = pod_is_pending(pod)
+                    logger.debug('pod name is %s and status is %s', pod.metadata.name, pod.status.phase)
+                if matching_pods and not any(matching_pods.values()):
+                    logger.info('No pending pods for %s', item_name)
+                    return True
+                if time.monotonic() >= deadline:
+                    break
+        except ApiException as e:
+            if e.status != 410:
+                raise
+            logger.debug('Pod watch expired, listing pods again') #resource version too old
+        finally:
+            pod_watch.stop()
+
+    logger.warning('Timed out after %ss waiting for pods of %s in %s', timeout, item_name, item_namespace)
+    return False
+
+def rollout_is_complete(kind, workload):
+    # the controller has seen the newest spec and every desired replica is updated and ready, like kubectl rollout status
+    status = workload.status
+    if status is None or (status.observed_generation or 0) < (workload.metadata.generation or 0):
+        return False
+    if kind == 'DaemonSet':
+        desired = status.desired_number_scheduled or 0
+        return (status.updated_number_scheduled or 0) == desired and (status.number_ready or 0) == desired
+    desired = workload.spec.replicas if workload.spec.replicas is not None else 1
+    if (status.updated_replicas or 0) != desired or (status.ready_replicas or 0) != desired:
+        return False
+    return kind != 'Deployment' or (status.replicas or 0) == desired #no pods of the old version left
+
+def rollout_status(kind, item_name, item_namespace, timeout=None):
+    # waits for a Deployment, StatefulSet or DaemonSet to finish rolling out. Straight after a rolling update
+    # the pods of the old version are still running, so the pods alone don't say whether it is ready. It is
+    # always listed once, even with no time left. Returns True when rolled out and False if the timeout is reached first
+    apps_v1 = get_apps_v1_api()
+    list_workloads = {'Deployment': apps_v1.list_namespaced_deployment, 'StatefulSet': apps_v1.list_namespaced_stateful_set,
+                      'DaemonSet': apps_v1.list_namespaced_daemon_set}[kind]
+    if timeout is None:
+        timeout = readiness_timeout
+    deadline = time.monotonic() + timeout
+    field_selector = f'metadata.name={item_name}'
 
-def find_corresponding_yaml(container_name):
-    string_found = False
-    string_to_find = str('app: ' + container_name)
-    full_file_array = []
-    for foldername, subfolders, filenames in os.walk(f'/{pvc_name}/{repo_name}/{folder_name}'):
-        for filename in filenames:
-            file_path = os.path.join(foldername, filename)
-            full_file_array.append(file_path)
-            print(file_path)
+    while True:
+        workload_list = list_workloads(item_namespace, field_selector=field_selector)
+        if any(rollout_is_complete(kind, workload) for workload in workload_list.items):
+            logger.info('%s %s rolled out', kind, item_name)
+            return True
+        if time.monotonic() >= deadline:
+            break
 
-    for file_name in full_file_array:
+        workload_watch = watch.Watch()
         try:
-            with open(file_name, 'r') as file:
-                file_content = file.read()
-                if string_to_find in file_content:
-                    string_found = True
-                    return file_name
+            for event in workload_watch.stream(list_workloads, item_namespace, field_selector=field_selector,
+                                               resource_version=workload_list.metadata.resource_version,
+                                               timeout_seconds=max(1, int(deadline - time.monotonic()))):
+                if event['type'] != 'DELETED' and rollout_is_complete(kind, event['object']):
+                    logger.info('%s %s rolled out', kind, item_name)
+                    return True
+                if time.monotonic() >= deadline:
+                    break
+        except ApiException as e:
+            if e.status != 410:
+                raise
+            logger.debug('%s watch expired, listing again', kind) #resource version too old
+        finally:
+            workload_watch.stop()
+
+    logger.warning('Timed out after %ss waiting for %s %s in %s to roll out', timeout, kind, item_name, item_namespace)
+    return False
+
+def documents_ready(documents, deadline=None):
+    # waits for the workloads one after another, all of them within the same deadline
+    if deadline is None:
+        deadline = time.monotonic() + readiness_timeout
+    all_ready = True
+    for document in documents:
+        # kubectl in the runner Job falls back to the namespace the Job runs in
+        started = time.monotonic()
+        timeout = max(0, deadline - started)
+        if document.kind in rolling_update_kinds:
+            ready = rollout_status(document.kind, document.name, document.namespace or 'admin', timeout)
+        else:
+            ready = pods_status(document.name, document.namespace or 'admin', manifest_label_selector(document.data), timeout)
+        observe_histogram('doris_readiness_wait_seconds', time.monotonic() - started, kind=document.kind, ready=str(ready).lower())
+        if not ready:
+            all_ready = False
+    return all_ready
+
+def watch_readiness(documents):
+    # starts waiting for the pods of the workloads in a manifest in the background and returns a future
+    # that resolves to True/False, or None if the manifest doesn't create pods straight away. The deadline
+    # runs from now, so a future that waited for a free readiness worker only gets the time that is left,
+    # but still checks once whether its workloads are ready
+    documents = [document for document in documents or () if document.error is None and document.kind in readiness_kinds]
+    if not documents:
+        return None
+    deadline = time.monotonic() + readiness_timeout
+    future = readiness_executor.submit(documents_ready, documents, deadline)
+    future.readiness_deadline = deadline
+    return future
+
+def wait_for_readiness(readiness_futures):
+    readiness_futures = [future for future in readiness_futures if future is not None]
+    if not readiness_futures:
+        return True
+    logger.debug('Waiting for %s workloads to become ready', len(readiness_futures))
+    # futures queued behind a full pool only make a last check once their deadline has passed, which the
+    # extra 10s covers
+    last_deadline = max(getattr(future, 'readiness_deadline', time.monotonic() + readiness_timeout) for future in readiness_futures)
+    done, not_done = concurrent.futures.wait(readiness_futures, timeout=max(0, last_deadline - time.monotonic()) + 10)
+    all_ready = not not_done
+    for future in done:
+        try:
+            if future.result() != True:
+                all_ready = False
         except Exception as e:
-            print(f"Error reading file '{file_name}': {e}")
-        
-    if string_found == False:
-        return 'no_yaml_found'
-
-def container_versions():
-
-    current_configmaps = get_configmaps()
-    print('Relevant configmap list is ', current_configmaps)
+            logger.error('Error waiting for pods: %s', e)
+            all_ready = False
+    if not all_ready:
+        logger.warning('Not all workloads became ready, carrying on')
+    return all_ready
+
+
+# libyaml's loader is many times faster than the pure python one, PyYAML only has it if it was built with libyaml
+yaml_safe_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# document separators, each document is parsed on its own so an error only affects that document
+yaml_document_separator = re.compile(r'^---[ \t]*(?:#.*)?$', re.MULTILINE)
+
+
+class ManifestDocument:
+    # one document of a manifest file. error is set instead of data if the document couldn't be parsed
+    __slots__ = ('path', 'number', 'data', 'kind', 'name', 'namespace', 'labels', 'app_labels', 'config_refs', 'error')
+
+    def __init__(self, path, number, data=None, error=None):
+        self.path = path
+        self.number = number #position in the file, from 0
+        self.data = data
+        self.error = error
+        metadata = (data or {}).get('metadata') or {}
+        self.kind = (data or {}).get('kind')
+        self.name = metadata.get('name')
+        self.namespace = metadata.get('namespace')
+        self.labels = metadata.get('labels') or {}
+        self.app_labels = manifest_app_labels(data) if data else set()
+        self.config_refs = manifest_config_refs(data) if self.kind in workload_kinds else set()
+
+    def __repr__(self):
+        if self.error is not None:
+            return f'ManifestDocument({self.path}#{self.number} error: {self.error})'
+        return f'ManifestDocument({self.path}#{self.number} {self.kind} {self.namespace}/{self.name})'
+
+def parse_manifest(text, path):
+    # every document in a manifest as a ManifestDocument, empty documents are left out
+    documents = []
+    for number, document_text in enumerate(yaml_document_separator.split(text)):
+        try:
+            data = yaml.load(document_text, Loader=yaml_safe_loader)
+        except yaml.YAMLError as e:
+            documents.append(ManifestDocument(path, number, error=f'YAML parsing error: {e}'))
+            continue
+        if data is None:
+            continue
+        if not isinstance(data, dict):
+            documents.append(ManifestDocument(path, number, error='not a Kubernetes object'))
+            continue
+        documents.append(ManifestDocument(path, number, data))
+    return documents
+
+# Parsed manifests shared by everything that reads a file, so a file is parsed once until it changes on the pvc.
+# Keyed by (path, mtime_ns, size) and evicted least recently used first, past either the entry or the byte
+# limit. The text is kept with the documents so rendering and checksums don't read the file again. Bytes are
+# counted as the size of the file, the parsed documents take a few times more
+manifest_cache = OrderedDict()
+manifest_cache_paths = {} # path -> its current key in manifest_cache
+manifest_cache_bytes = 0
+manifest_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+manifest_cache_lock = threading.Lock()
+
+
+def remove_cached_manifest(cache_key):
+    global manifest_cache_bytes
+    manifest_cache.pop(cache_key)
+    manifest_cache_bytes -= cache_key[2]
+    if manifest_cache_paths.get(cache_key[0]) == cache_key:
+        del manifest_cache_paths[cache_key[0]]
+
+def cache_manifest(cache_key, manifest_file):
+    global manifest_cache_bytes
+    with manifest_cache_lock:
+        previous_key = manifest_cache_paths.get(cache_key[0])
+        if previous_key is not None and previous_key in manifest_cache:
+            remove_cached_manifest(previous_key) #an older version of the same file
+        manifest_cache[cache_key] = manifest_file
+        manifest_cache_paths[cache_key[0]] = cache_key
+        manifest_cache_bytes += cache_key[2]
+        while len(manifest_cache) > 1 and (len(manifest_cache) > manifest_cache_max_entries or manifest_cache_bytes > manifest_cache_max_bytes):
+            remove_cached_manifest(next(iter(manifest_cache)))
+            manifest_cache_stats['evictions'] += 1
+
+def load_manifest_file(path):
+    # text and documents of a manifest file on the pvc. An unreadable file has no text and is one document
+    # with an error. Both are shared through the cache so mustn't be changed
+    path = '/' + path.lstrip('/')
+    try:
+        file_stat = os.stat(path)
+        cache_key = (path, file_stat.st_mtime_ns, file_stat.st_size)
+        with manifest_cache_lock:
+            manifest_file = manifest_cache.get(cache_key)
+            if manifest_file is not None:
+                manifest_cache.move_to_end(cache_key)
+                manifest_cache_stats['hits'] += 1
+                return manifest_file
+            manifest_cache_stats['misses'] += 1
+        with open(path, 'r') as file:
+            text = file.read()
+    except OSError as e:
+        return None, [ManifestDocument(path, 0, error=f"Error reading file '{path}': {e}")]
+    manifest_file = (text, parse_manifest(text, path))
+    cache_manifest(cache_key, manifest_file)
+    return manifest_file
+
+def load_manifest(path):
+    # documents of a manifest file on the pvc, see load_manifest_file
+    return load_manifest_file(path)[1]
+
+def primary_document(documents):
+    # the document a file is deployed as: its first workload, otherwise its first object
+    documents = [document for document in documents or () if document.error is None]
+    return next((document for document in documents if document.kind in workload_kinds), documents[0] if documents else None)
+
+def print_manifest_errors(documents):
+    for document in documents:
+        if document.error is not None:
+            logger.warning('Skipping document %s of %s: %s', document.number, document.path, document.error)
+
+
+# In-memory index of the yaml repo, built once per checked out commit and updated from the
+# changed file list afterwards. Paths are absolute paths on the pvc, as os.walk returned them
+manifest_index = {
+    'commit': None,
+    'files': {},      # path -> list of ManifestDocument
+    'app': {},        # app label -> set of paths
+    'kind': {},       # kind -> set of paths
+    'name': {},       # metadata name -> set of paths
+    'namespace': {},  # metadata namespace -> set of paths
+    'config_ref': {}, # ('ConfigMap' or 'Secret', name) -> set of paths of the workloads using it
+}
+manifest_index_keys = ('app', 'kind', 'name', 'namespace', 'config_ref')
+
+workload_kinds = {'Pod', 'Job', 'CronJob', 'Deployment', 'ReplicaSet', 'StatefulSet', 'DaemonSet'}
+# kinds used at the end of manifest file names, longest first so e.g. clusterrolebinding wins over rolebinding
+manifest_kind_suffixes = sorted(['namespace', 'volume', 'persistentvolume', 'persistentvolumeclaim', 'pv', 'pvc', 'storageclass',
+                                 'secret', 'serviceaccount', 'role', 'rolebinding', 'clusterrole', 'clusterrolebinding', 'configmap',
+                                 'job', 'cronjob', 'pod', 'replicaset', 'deployment', 'statefulset', 'daemonset', 'service',
+                                 'ingress', 'endpoint'], key=len, reverse=True)
+
+
+def dict_path(yaml_data, *keys):
+    # yaml_data[key1][key2]..., None if any step is missing or not a mapping
+    for key in keys:
+        if not isinstance(yaml_data, dict):
+            return None
+        yaml_data = yaml_data.get(key)
+    return yaml_data
+
+def pod_template_labels(yaml_data):
+    # labels of the pods a workload creates, a CronJob's pod template is inside its job template
+    if dict_path(yaml_data, 'kind') == 'CronJob':
+        return dict_path(yaml_data, 'spec', 'jobTemplate', 'spec', 'template', 'metadata', 'labels')
+    return dict_path(yaml_data, 'spec', 'template', 'metadata', 'labels')
+
+def manifest_app_labels(yaml_data):
+    # app labels of the object itself: its own labels, its selector and its pod template. Labels it only refers
+    # to, e.g. in an affinity or a topology spread constraint, belong to other apps and are left out
+    app_labels = set()
+    for labels in (dict_path(yaml_data, 'metadata', 'labels'), dict_path(yaml_data, 'spec', 'selector', 'matchLabels'),
+                   pod_template_labels(yaml_data)):
+        if isinstance(labels, dict) and labels.get('app') is not None:
+            app_labels.add(str(labels['app']))
+    return app_labels
+
+def manifest_config_refs(yaml_data):
+    # configmaps and secrets used through volumes (including projected ones), envFrom, env valueFrom and imagePullSecrets
+    config_refs = set()
+    if isinstance(yaml_data, dict):
+        for key, value in yaml_data.items():
+            if not isinstance(value, (dict, list)):
+                continue
+            if key in ('configMap', 'configMapRef', 'configMapKeyRef') and isinstance(value, dict) and value.get('name'):
+                config_refs.add(('ConfigMap', str(value['name'])))
+            elif key == 'secret' and isinstance(value, dict) and value.get('secretName'):
+                config_refs.add(('Secret', str(value['secretName'])))
+            elif key in ('secret', 'secretRef', 'secretKeyRef') and isinstance(value, dict) and value.get('name'):
+                config_refs.add(('Secret', str(value['name'])))
+            elif key == 'imagePullSecrets' and isinstance(value, list):
+                for pull_secret in value:
+                    if isinstance(pull_secret, dict) and pull_secret.get('name'):
+                        config_refs.add(('Secret', str(pull_secret['name'])))
+            config_refs.update(manifest_config_refs(value))
+    elif isinstance(yaml_data, list):
+        for item in yaml_data:
+            config_refs.update(manifest_config_refs(item))
+    return config_refs
+
+def manifest_index_values(documents):
+    index_values = {index_key: set() for index_key in manifest_index_keys}
+    for document in documents:
+        index_values['app'].update(document.app_labels)
+        index_values['kind'].add(document.kind)
+        index_values['name'].add(document.name)
+        index_values['namespace'].add(document.namespace)
+        index_values['config_ref'].update(document.config_refs)
+    return index_values
+
+def unindex_manifest_file(file_path):
+    documents = manifest_index['files'].pop(file_path, None)
+    if documents is None:
+        return
+    for index_key, values in manifest_index_values(documents).items():
+        for value in values:
+            paths = manifest_index[index_key].get(value)
+            if paths is not None:
+                paths.discard(file_path)
+                if not paths:
+                    del manifest_index[index_key][value]
+
+def index_manifest_file(file_path):
+    unindex_manifest_file(file_path)
+    if not file_path.endswith(('.yml', '.yaml')) or not os.path.isfile(file_path):
+        return
+    documents = load_manifest(file_path)
+    print_manifest_errors(documents)
+    documents = [document for document in documents if document.error is None]
+    if not documents:
+        return
+    manifest_index['files'][file_path] = documents
+    for index_key, values in manifest_index_values(documents).items():
+        for value in values:
+            manifest_index[index_key].setdefault(value, set()).add(file_path)
+
+def build_manifest_index(commit_sha):
+    for index_key in ('files',) + manifest_index_keys:
+        manifest_index[index_key] = {}
+    for foldername, subfolders, filenames in os.walk(f'/{pvc_name}/{repo_name}/{folder_name}'):
+        for filename in filenames:
+            index_manifest_file(os.path.join(foldername, filename))
+    manifest_index['commit'] = commit_sha
+    logger.info('Manifest index built for commit %s with %s files', commit_sha, len(manifest_index['files']))
+
+def update_manifest_index(commit_sha, changed_files):
+    # changed_files are paths relative to the repo, as listed by GitHub for a commit
+    for changed_file in changed_files:
+        index_manifest_file(f'/{pvc_name}/{repo_name}/' + changed_file)
+    manifest_index['commit'] = commit_sha
+    logger.info('Manifest index updated for commit %s with %s changed files', commit_sha, len(changed_files))
+
+def ensure_manifest_index():
+    # the repo may already be on the pvc from before a restart
+    local_dir = f'/{pvc_name}/{repo_name}'
+    if manifest_index['commit'] is None and os.path.exists(local_dir):
+        build_manifest_index(Repo(local_dir).head.commit.hexsha)
+
+def lookup_manifests(**criteria):
+    # e.g. lookup_manifests(app='influxdb', kind='Deployment'), returns sorted paths matching every criterion
+    ensure_manifest_index()
+    matches = None
+    for index_key, value in criteria.items():
+        paths = manifest_index[index_key].get(value, set())
+        matches = set(paths) if matches is None else matches & paths
+    return sorted(matches or ())
+
+def build_package_images(reconcile_state):
+    # package name (without the custom prefix) -> image url, built once per cycle and kept up to date by container_versions
+    return {package_name: package['image'] for package_name, package in reconcile_state['packages'].items()}
+
+def manifest_file_container_name(file_path):
+    # files are named <order>-<container name><kind>.yml, e.g. 170-influxdbdeployment.yml -> influxdb
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    file_name = file_name.split('-', 1)[-1].lower()
+    for kind_suffix in manifest_kind_suffixes:
+        if file_name.endswith(kind_suffix) and len(file_name) > len(kind_suffix):
+            return file_name[:-len(kind_suffix)]
+    return file_name
+
+def resolve_image_url(yaml_file, package_images):
+    # the package named by the app label of the workload itself (its own or its pod template's label), or by the
+    # container name in the file name. If they name different packages none of them is used
+    package_names = set()
+    document = primary_document(load_manifest(yaml_file))
+    if document is not None:
+        for labels in (dict_path(document.data, 'metadata', 'labels'), pod_template_labels(document.data)):
+            if isinstance(labels, dict) and str(labels.get('app')) in package_images:
+                package_names.add(str(labels['app']))
+    container_name = manifest_file_container_name(yaml_file)
+    if container_name in package_images:
+        package_names.add(container_name)
+    if len(package_names) > 1:
+        logger.warning('%s matches the packages %s, give its app label and file name the same package name', yaml_file, ', '.join(sorted(package_names)))
+        return "default"
+    if package_names:
+        package_name = package_names.pop()
+        logger.debug('Image url for %s is %s', yaml_file, package_images[package_name])
+        return package_images[package_name]
+    logger.debug('Standard package deployment')
+    return "default"
 
-    url = f"https://api.github.com/users/{user_account}/packages?package_type=container"
+def find_corresponding_yaml(container_name):
+    file_paths = lookup_manifests(app=container_name)
+    for file_path in file_paths:
+        if any(document.kind in workload_kinds for document in manifest_index['files'][file_path]):
+            return file_path
+    if file_paths:
+        return file_paths[0]
+    return 'no_yaml_found'
+
+
+class Package:
+    # a container package of this cluster in GHCR
+    __slots__ = ('name', 'ghcr_name', 'id', 'digest', 'image', 'modified')
+
+    def __init__(self, name, ghcr_name, package_id):
+        self.name = name #name used in this cluster, without the custom prefix
+        self.ghcr_name = ghcr_name
+        self.id = int(package_id) #GitHub ids don't fit in 32 bits for long
+        self.digest = None
+        self.image = None
+        self.modified = True #False if GitHub said its versions hadn't changed since the stored image was found
+
+    def state(self):
+        # how the package is stored in the reconcile state
+        return {'id': str(self.id), 'image': str(self.image)}
+
+class PackageRegistry:
+    # packages of this cluster listed from GHCR keyed by their full GHCR name, and what has changed since
+    # they were last stored in the reconcile state
+    def __init__(self):
+        self.packages = {}
+        self.complete = True #False if listing failed part way, so missing packages may not have been removed
+
+    def add(self, ghcr_name, package_id):
+        if ghcr_name.startswith(custom_container_prefix + '-'):
+            logger.debug('Custom prefix found in %s', ghcr_name)
+            name = ghcr_name[len(custom_container_prefix + '-'):]
+        elif "pipelineinitialisation" in ghcr_name:
+            name = ghcr_name
+        else:
+            logger.debug('%s is not being used in this cluster', ghcr_name)
+            return None
+        package = Package(name, ghcr_name, package_id)
+        self.packages[ghcr_name] = package
+        return package
+
+    def resolved(self):
+        # packages whose newest version was found, by cluster name
+        return {package.name: package for package in self.packages.values() if package.image is not None}
+
+    def changes(self, stored_packages):
+        # names of the packages added, changed and removed since stored_packages
+        resolved = self.resolved()
+        added = resolved.keys() - stored_packages.keys()
+        changed = {name for name in resolved.keys() & stored_packages.keys()
+                   if resolved[name].modified and resolved[name].state() != stored_packages[name]}
+        removed = set()
+        if self.complete:
+            removed = stored_packages.keys() - {package.name for package in self.packages.values()}
+        return added, changed, removed
+
+def list_packages(token):
+    url = f"{github_api_url}/users/{user_account}/packages?package_type=container&per_page=100"
+    registry = PackageRegistry()
+    try:
+        for entry in (entry for page, modified in github_pages(url, token) for entry in page):
+            registry.add(str(entry['name']), entry['id'])
+    except Exception as e:
+        logger.error('Error with GitHub API when gathering list of container images: %s', e)
+        registry.complete = False
+    return registry
 
-    token = os.getenv('package-checker-token')
+def get_package_version(ghcr_image_name, token, stored_image=None):
+    # returns the digest and image url of the newest version and whether it may have changed. If GitHub says
+    # the versions haven't changed (304) stored_image is returned as it is. Errors only affect this package,
+    # None is returned so the others can carry on
+    url = f"{github_api_url}/user/packages/container/" + str(ghcr_image_name) + "/versions?per_page=1" #newest version first
 
-    headers = {
-    "Accept": "application/vnd.github+json",
-    "Authorization": f"Bearer {token}",
-    "X-GitHub-Api-Version": "2022-11-28"
-    }
     try:
-        response = requests.request("GET", url, headers=headers)
-        json_data = json.loads(response.text)
-
-        # Initialize an empty NumPy array
-        package_name_array = np.array([])
-        package_id_array = np.array([], dtype='int16')
-
-        # Iterate over each entry and append values to the array
-        for entry in json_data:
-            print('Entry is: ', entry)
-            name = entry['name']
-            print('Name is', name)
-            id = entry['id']
-            if str(custom_container_prefix+'-') in str(name):
-                print(f'Custom prefix found in {name}')
-                package_name = str(name)[len(str(custom_container_prefix+"-")):]
-            # Create a numpy array with the values for the current entry
-                package_name = np.array([package_name])
-                package_id = np.array([id])
-            # Append the entry array to the result array
-                package_name_array = np.append(package_name_array, package_name)
-                package_id_array = np.append(package_id_array, package_id)
-            elif "pipelineinitialisation" in name:
-                package_name = np.array([name])
-                package_id = np.array([id])
-                package_name_array = np.append(package_name_array, package_name)
-                package_id_array = np.append(package_id_array, package_id)
-            else:
-                print(f'{name} is not being used in this cluster')
-
+        json_data, modified = github_get(url, token)
+        if not modified and stored_image is not None:
+            return stored_image.rsplit('@', 1)[-1], stored_image, False
+        sha_value = next((item['name'] for item in json_data if 'name' in item), None)
     except Exception as e:
-        print('Error with GitHub API when gathering list of container images')
-    package_number = 0
-    print('package name array is: ', package_name_array)
+        logger.error('Error with GitHub API when getting details of package %s: %s', ghcr_image_name, e)
+        return None
 
-    for package_name in package_name_array:
+    image_url = f'ghcr.io/{user_account}/' + str(ghcr_image_name) + ':main@' + str(sha_value)
+    return sha_value, image_url, True
 
-        if "pipelineinitialisation" not in package_name:
-            ghcr_image_name = custom_container_prefix+'-'+package_name
-        else:
-            ghcr_image_name = package_name
-        
-        url = "https://api.github.com/user/packages/container/" + str(ghcr_image_name) + "/versions"
+def redeploy_package(package):
+    # applies the manifest using the package with its new image, returns its readiness future
+    yaml_file = find_corresponding_yaml(package.name)
+    if yaml_file == 'no_yaml_found':
+        logger.info('No corresponding yaml file found for %s', package.name)
+        return None
+    logger.debug('Applying new package version')
+    job_name = str(''.join(random.choices(string.ascii_lowercase, k=5)) + '-' + package.name)
+    documents = load_manifest(yaml_file)
+    print_manifest_errors(documents)
+    document = primary_document(documents)
+    if document is None:
+        return None
+    delete_and_deploy_flag = True
+    return runyaml(job_name, str(package.image), yaml_file, 'apply', delete_and_deploy_flag, document.kind, document.name, document.namespace)
 
-        headers = {
-        "Accept": "application/vnd.github+json",
-        "Authorization": f"Bearer {token}",
-        "X-GitHub-Api-Version": "2022-11-28"
-        }
+def container_versions(reconcile_state, package_images):
 
+    # returns whether any package was added, updated or removed, and whether every package could be checked with GitHub
+    stored_packages = reconcile_state['packages']
+    token = os.getenv('package-checker-token')
+
+    registry = list_packages(token)
+    logger.debug('packages are: %s', sorted(registry.packages))
+
+    # versions of every package are fetched in parallel, results come back in package order
+    packages = list(registry.packages.values())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=github_max_workers) as executor:
+        package_versions = list(executor.map(lambda package: get_package_version(
+            package.ghcr_name, token, stored_packages.get(package.name, {}).get('image')), packages))
+    synced = registry.complete
+    for package, package_version in zip(packages, package_versions):
+        if package_version is not None:
+            package.digest, package.image, package.modified = package_version
+        else:
+            synced = False
+
+    added, changed, removed = registry.changes(stored_packages)
+    resolved = registry.resolved()
+
+    for package_name in sorted(added): #only apply once yaml file has been put in place so won't be run from here
+        logger.info('New package %s with id %s and image %s', package_name, resolved[package_name].id, resolved[package_name].image)
+        stored_packages[package_name] = resolved[package_name].state()
+        package_images[package_name] = resolved[package_name].image
+
+    readiness_futures = []
+    start_apply_batch() #with job-batch-mode all new package versions are rolled out by one Job
+    for package_name in sorted(changed):
+        package = resolved[package_name]
+        logger.info('Updating package %s to id %s and image %s', package_name, package.id, package.image)
+        stored_packages[package_name] = package.state()
+        package_images[package_name] = package.image
         try:
-            response = requests.request("GET", url, headers=headers)
-            json_data = json.loads(response.text)
-
-            sha_value = next((item['name'] for item in json_data if 'name' in item), None)
-
-            image_url = f'ghcr.io/{user_account}/' + str(ghcr_image_name) + ':main@' + str(sha_value)
-
-            print('package id is :', package_id_array[package_number])
-            print('package_name is :', package_name)
-            print('sha_value is :', sha_value)
-            print("image_url is: ", image_url)
-
-            if str('containerlist-'+package_name) in current_configmaps: 
-                print('Existing configmap')
-                stored_configmaps_values = get_configmap_data('containerlist-'+package_name)
-                stored_configmap_key = str(stored_configmaps_values[0])
-                stored_configmap_value = str(stored_configmaps_values[1])
-                if str(package_id_array[package_number])!=stored_configmap_key or str(image_url)!=stored_configmap_value:
-                    print('Updating Configmap')
-                    update_configmap(str('containerlist-'+package_name), str(package_id_array[package_number]), str(image_url))
-                    yaml_file = find_corresponding_yaml(package_name)
-                    job_name = str(''.join(random.choices(string.ascii_lowercase, k=5)) + '-' + package_name)
-                    if yaml_file!='no_yaml_found':
-                        print('Applying new package version') #NEED TO CHANGE SO THAT IT DELETES OLD POD FIRST
-                        delete_and_deploy_flag = True
-                        with open(str('/' + yaml_file), 'r') as file:
-                            try:
-                                yaml_data = yaml.safe_load(file)
-                                yaml_kind = yaml_data.get('kind')
-                                item_name = yaml_data.get('metadata', {}).get('name', None)
-                                item_namespace = yaml_data.get('metadata', {}).get('namespace', None)
-                            except ComposerError as e:
-                                    print(f"YAML parsing error: {e}. Remove --- or multiple yaml components")
-                                    break
-                            except Exception as e:
-                                print(f"An unexpected error occurred: {e}")
-                                break
-                        runyaml(job_name, str(image_url), yaml_file, 'apply', delete_and_deploy_flag, yaml_kind, item_name, item_namespace) #this will only run for changes
-                    else:
-                        print('No corresponding yaml file found for ', package_name)
-                else:
-                    print('Package configuration unchanged')
-            else: #new packages need adding
-                apply_configmap(str(package_name), str(package_id_array[package_number]), str(image_url))
-                #only apply once yaml file has been put in place so won't be run from here
+            readiness_futures.append(redeploy_package(package))
         except Exception as e:
-            print('Error with GitHub API when getting details of package')
-        package_number+=1
+            logger.error('Error updating package %s: %s', package_name, e)
 
-    # check old configmap names and delete if package if no longer there
-    # hasn't been fully tested as would need to delete package from ghcr
-    for configmapitem in current_configmaps:
-        print('Checking configmap item: ', configmapitem)
-        still_in_array = False
-        configmapitem_name = str(configmapitem).split('-')[1]
-        for name_value in package_name_array:
-            #checking to see if old packages can be deleted from configmap
-            if configmapitem_name in name_value:
-                still_in_array = True
-                break
-            else:
-                print('Going through other options')
+    batch_results, batch_futures = run_apply_batch('packages')
+    readiness_futures.extend(batch_futures)
+    wait_for_readiness(readiness_futures)
 
-        if still_in_array == False:
-            delete_configmap(configmapitem)
-        else:
-            print('Configmap still present')
+    # old packages are removed from the state if the package is no longer there
+    # hasn't been fully tested as would need to delete package from ghcr
+    if not registry.complete:
+        logger.warning('Package list incomplete, not removing old packages')
+    for package_name in sorted(removed):
+        logger.info('Package %s no longer in GHCR, removing it', package_name)
+        del stored_packages[package_name]
+        package_images.pop(package_name, None)
+    return bool(added or changed or removed), synced
 
 
-def cloneyamlrepo(commit_hash):
-    access_token = os.getenv('clone-yaml-token')
-    repo_url = 'https://' + user_account + ':' + access_token + '@' + f'github.com/{user_account}/{repo_name}.git'
+def get_yaml_repo(fetch=True):
     local_dir = f'/{pvc_name}/{repo_name}' #pvc folder location
-    print(local_dir)
-    print('Here 1')
+    logger.debug('%s', local_dir)
     if os.path.exists(local_dir):
-        print('file location exists')
+        logger.debug('file location exists')
         repo = Repo(local_dir)
-        repo.git.fetch()
+        if fetch:
+            repo.git.fetch()
     else:
+        access_token = os.getenv('clone-yaml-token')
+        repo_url = 'https://' + user_account + ':' + access_token + '@' + f'github.com/{user_account}/{repo_name}.git'
         repo = Repo.clone_from(repo_url, local_dir) #on mac can't create folder. Works on pi
-    print('Commit hash is : ', commit_hash)
-    repo.git.checkout(commit_hash)
-    print("Repository cloned successfully")
+    return repo
+
+def cloneyamlrepo(commit_hash, changed_files=None, fetch=True):
+    # fetch=False when the repo was already fetched this cycle
+    with timing_span('checkout'):
+        repo = get_yaml_repo(fetch)
+        logger.debug('Commit hash is : %s', commit_hash)
+        repo.git.checkout(commit_hash)
+    logger.info('Repository cloned successfully')
+    if changed_files is not None and manifest_index['commit'] is not None:
+        update_manifest_index(commit_hash, changed_files)
+    else:
+        build_manifest_index(commit_hash)
+
+
+def render_manifest(yaml_file, image_url_var):
+    # same substitutions the runner Job does with sed, on the cached text of the file
+    text, documents = load_manifest_file(yaml_file)
+    if text is None:
+        raise OSError(documents[0].error)
+    text = text.replace('pull_ghcr_image_token', str(os.getenv('pull-ghcr-image-token')))
+    return text.replace('image_url_var', str(image_url_var))
+
+def fill_placeholders(value, image_url_var, pull_ghcr_image_token):
+    # copy of parsed yaml with the placeholders in every string replaced
+    if isinstance(value, str):
+        return value.replace('pull_ghcr_image_token', pull_ghcr_image_token).replace('image_url_var', image_url_var)
+    if isinstance(value, dict):
+        return {fill_placeholders(key, image_url_var, pull_ghcr_image_token): fill_placeholders(item, image_url_var, pull_ghcr_image_token)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill_placeholders(item, image_url_var, pull_ghcr_image_token) for item in value]
+    return value
+
+def render_documents(yaml_file, image_url_var):
+    # the cached documents of a file with the placeholders filled in, so the file isn't parsed again to apply it
+    pull_ghcr_image_token = str(os.getenv('pull-ghcr-image-token'))
+    rendered_documents = []
+    for document in load_manifest(yaml_file):
+        if document.error is not None:
+            rendered_documents.append(document)
+        else:
+            rendered_data = fill_placeholders(document.data, str(image_url_var), pull_ghcr_image_token)
+            rendered_documents.append(ManifestDocument(document.path, document.number, rendered_data))
+    return rendered_documents
 
+def get_manifest_resource(yaml_data):
+    dynamic_client = get_dynamic_client()
+    try:
+        return dynamic_client.resources.get(api_version=yaml_data.get('apiVersion'), kind=yaml_data.get('kind'))
+    except ResourceNotFoundError:
+        # the kind may come from a CustomResourceDefinition created since the API was last discovered
+        dynamic_client.resources.invalidate_cache()
+        return dynamic_client.resources.get(api_version=yaml_data.get('apiVersion'), kind=yaml_data.get('kind'))
+
+def delete_resource(resource, name, namespace, wait):
+    # returns False if there was nothing to delete
+    try:
+        resource.delete(name=name, namespace=namespace, propagation_policy='Background')
+    except ApiException as e:
+        if e.status == 404:
+            return False
+        raise
+    deadline = time.monotonic() + delete_timeout
+    while wait and time.monotonic() < deadline:
+        try:
+            resource.get(name=name, namespace=namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return True
+            raise
+        time.sleep(1)
+    if wait:
+        logger.warning('%s still being deleted after %ss', name, delete_timeout)
+    return True
+
+def redeploy_method(kind):
+    # how a changed workload is restarted: 'rolling' (a pod template annotation changes so the controller
+    # rolls the pods over), 'recreate' (deleted then applied again) or 'apply' (the new version is used the
+    # next time it runs, e.g. a CronJob)
+    kind = next((workload_kind for workload_kind in workload_kinds if workload_kind.lower() == str(kind).lower()), None)
+    if kind is None:
+        return 'apply'
+    if redeploy_strategy == 'rolling':
+        if kind in rolling_update_kinds:
+            return 'rolling'
+        if kind not in recreate_kinds:
+            return 'apply'
+    return 'recreate'
+
+def config_checksum(yaml_data):
+    # sha256 of the configmap and secret files in the repo that a workload uses
+    checksum = hashlib.sha256()
+    for config_kind, config_name in sorted(manifest_config_refs(yaml_data)):
+        for config_file in lookup_manifests(kind=config_kind, name=config_name):
+            config_text = load_manifest_file(config_file)[0]
+            if config_text is not None:
+                checksum.update(config_text.encode())
+    return checksum.hexdigest()
+
+def add_config_checksum(yaml_data):
+    template = (yaml_data.get('spec') or {}).get('template')
+    if not isinstance(template, dict):
+        return
+    if not isinstance(template.get('metadata'), dict):
+        template['metadata'] = {}
+    if not isinstance(template['metadata'].get('annotations'), dict):
+        template['metadata']['annotations'] = {}
+    template['metadata']['annotations'][config_checksum_annotation] = config_checksum(yaml_data)
+
+def apply_manifest(yaml_file, image_url_var, state, delete_and_deploy_flag):
+    # applies (server-side apply) or deletes every document in a manifest file and returns one result per
+    # document. With delete_and_deploy_flag workloads are restarted as redeploy_method() says, everything
+    # else is applied
+    apply_results = []
+    for document in render_documents(yaml_file, image_url_var):
+        yaml_data = document.data
+        apply_result = {'file': yaml_file, 'kind': document.kind, 'name': document.name,
+                        'namespace': document.namespace, 'action': None, 'ok': False, 'error': document.error}
+        apply_results.append(apply_result)
+        if document.error is not None:
+            inc_counter('doris_manifest_operations_total', operation='apply', result='error')
+            continue
+        started = time.monotonic()
+        try:
+            resource = get_manifest_resource(yaml_data)
+            if resource.namespaced and apply_result['namespace'] is None:
+                apply_result['namespace'] = 'admin' #same default kubectl had inside the runner Job
+            namespace = apply_result['namespace'] if resource.namespaced else None
+
+            if state == 'delete':
+                deleted = delete_resource(resource, apply_result['name'], namespace, wait=False)
+                apply_result['action'] = 'deleted' if deleted else 'not found'
+            else:
+                apply_result['action'] = 'applied'
+                redeploy = redeploy_method(apply_result['kind'])
+                if redeploy == 'rolling':
+                    # always set so that a plain apply doesn't remove it, it only changes with the configuration
+                    add_config_checksum(yaml_data)
+                    if delete_and_deploy_flag:
+                        apply_result['action'] = 'rolled'
+                elif redeploy == 'recreate' and delete_and_deploy_flag:
+                    if delete_resource(resource, apply_result['name'], namespace, wait=True):
+                        apply_result['action'] = 'recreated'
+                resource.server_side_apply(body=yaml_data, name=apply_result['name'], namespace=namespace,
+                                           field_manager=field_manager, force_conflicts=True)
+            apply_result['ok'] = True
+        except Exception as e:
+            apply_result['error'] = str(e)
+        observe_histogram('doris_kube_apply_duration_seconds', time.monotonic() - started, operation=state)
+        inc_counter('doris_manifest_operations_total', operation=apply_result['action'] or state, result='ok' if apply_result['ok'] else 'error')
+    return apply_results
 
-def runyaml(jobname, image_url_var, yaml_file, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace):
-    pull_ghcr_image_token = os.getenv('pull-ghcr-image-token')
-    config.load_incluster_config()
-    api_instance = client.BatchV1Api()
+# sha256 of the rendered manifest last applied from each file, kept in the reconcile state so a file whose
+# rendered output hasn't changed isn't applied (or deleted and recreated) again. reconcile() points this at
+# the 'manifests' entry of the state it has read
+manifest_hashes = {}
 
-    job_manifest = client.V1Job(
+
+def manifest_key(yaml_file):
+    return '/' + yaml_file.lstrip('/')
+
+def rendered_manifest_hash(yaml_file, image_url_var):
+    # None if the file can't be read
+    try:
+        return hashlib.sha256(render_manifest(yaml_file, image_url_var).encode()).hexdigest()
+    except OSError as e:
+        logger.warning('Could not render %s: %s', yaml_file, e)
+        return None
+
+def manifest_is_applied(yaml_file, image_url_var):
+    rendered_hash = rendered_manifest_hash(yaml_file, image_url_var)
+    return rendered_hash is not None and manifest_hashes.get(manifest_key(yaml_file)) == rendered_hash
+
+def is_controller_document(document):
+    # the pipelineinitialisation micro-service itself, found by its app label or name
+    return any('pipelineinitialisation' in app_label for app_label in document.app_labels) or 'pipelineinitialisation' in str(document.name)
+
+def recreated_controller_document(yaml_file, state, delete_and_deploy_flag):
+    # the document of the pipeline's own workload if applying yaml_file would delete and recreate it, otherwise None
+    if state == 'delete' or not delete_and_deploy_flag:
+        return None
+    for document in load_manifest(yaml_file):
+        if document.error is None and redeploy_method(document.kind) == 'recreate' and is_controller_document(document):
+            return document
+    return None
+
+def runyaml(jobname, image_url_var, yaml_file, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace, force=False):
+    # force applies the file even if it is unchanged, for workloads that need restarting to pick up a
+    # changed configmap or secret. The hash of the file is only kept once it is known to have been applied,
+    # which an unbatched Job isn't waited for, so those files are always applied again when asked to
+    rendered_hash = None
+    if state == 'delete':
+        manifest_hashes.pop(manifest_key(yaml_file), None)
+    else:
+        rendered_hash = rendered_manifest_hash(yaml_file, image_url_var)
+        if not force and rendered_hash is not None and manifest_hashes.get(manifest_key(yaml_file)) == rendered_hash:
+            logger.debug('%s is unchanged since it was last applied, skipping', yaml_file)
+            inc_counter('doris_manifests_skipped_total')
+            return None
+
+    if apply_batch is not None:
+        add_to_apply_batch(image_url_var, yaml_file, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace, rendered_hash, force)
+        return None #readiness is checked once the batch has run
+
+    controller_document = recreated_controller_document(yaml_file, state, delete_and_deploy_flag)
+    if apply_engine == 'server-side' and controller_document is not None:
+        # deleting the pipeline's own pod from in here would stop it before it applied the new version,
+        # so a runner Job deletes and applies it like the job engine does
+        logger.info('Recreating %s %s with a Job as it is this pipeline', controller_document.kind, controller_document.name)
+        create_apply_job(jobname, image_url_var, yaml_file, state, delete_and_deploy_flag, controller_document.kind,
+                         controller_document.name, controller_document.namespace or 'admin', force)
+        manifest_hashes.pop(manifest_key(yaml_file), None) #the Job isn't waited for, so whether it worked isn't known
+    elif apply_engine == 'server-side':
+        try:
+            apply_ok = True
+            for apply_result in apply_manifest(yaml_file, image_url_var, state, delete_and_deploy_flag):
+                if apply_result['ok']:
+                    logger.info('%s %s %s', apply_result['kind'], apply_result['name'], apply_result['action'])
+                else:
+                    apply_ok = False
+                    logger.error('Error applying %s %s from %s: %s', apply_result['kind'], apply_result['name'], yaml_file, apply_result['error'])
+            if apply_ok and rendered_hash is not None:
+                manifest_hashes[manifest_key(yaml_file)] = rendered_hash
+        except Exception as e:
+            logger.error('Error applying %s: %s', yaml_file, e)
+    else:
+        create_apply_job(jobname, image_url_var, yaml_file, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace, force)
+        manifest_hashes.pop(manifest_key(yaml_file), None) #the Job isn't waited for, so whether it worked isn't known
+
+    readiness = None
+    if state != 'delete':
+        readiness = watch_readiness(load_manifest(yaml_file))
+
+    logger.debug('Finished job')
+    return readiness
+
+def apply_job_manifest(jobname, command, backoff_limit=2):
+    return client.V1Job(
         api_version="batch/v1",
         kind="Job",
         metadata=client.V1ObjectMeta(
@@ -349,7 +1440,7 @@ def runyaml(jobname, image_url_var, yaml_file, state, delete_and_deploy_flag, ya
             namespace="admin",
         ),
         spec=client.V1JobSpec(
-            backoff_limit=2,
+            backoff_limit=backoff_limit,
             template=client.V1PodTemplateSpec(
                 spec=client.V1PodSpec(
                     service_account_name="admin-sa",
@@ -357,7 +1448,7 @@ def runyaml(jobname, image_url_var, yaml_file, state, delete_and_deploy_flag, ya
                         client.V1Container(
                             name="script",
                             image="bitnami/kubectl:latest",
-                            command=["/bin/bash", "-c", f'cat {yaml_file} | sed "s#pull_ghcr_image_token#{pull_ghcr_image_token}#g" | sed "s#image_url_var#{image_url_var}#g" | if [[ "{delete_and_deploy_flag}" == "True" ]]; then echo "Delete first"; kubectl delete {yaml_kind} {item_name} -n {item_namespace}; echo "Deletion Occured"; kubectl apply -f -; echo "Redeploy complete"; else kubectl {state} -f -; fi'],
+                            command=["/bin/bash", "-c", command],
                             volume_mounts=[client.V1VolumeMount(mount_path=f"/{pvc_name}", name="yaml-files")]
                         )    
                     ],
@@ -368,69 +1459,263 @@ def runyaml(jobname, image_url_var, yaml_file, state, delete_and_deploy_flag, ya
         )
     )
 
+def create_apply_job(jobname, image_url_var, yaml_file, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace, force=False):
+    # a changed spec is rolled out by the apply itself, force restarts the pods when only a configmap or secret changed
+    pull_ghcr_image_token = os.getenv('pull-ghcr-image-token')
+    api_instance = get_batch_v1_api()
+
+    redeploy = redeploy_method(yaml_kind) if delete_and_deploy_flag and state != 'delete' else 'apply'
+    if redeploy == 'rolling' and force:
+        kubectl_command = f'kubectl apply -f -; echo "Restarting"; kubectl rollout restart {yaml_kind} {item_name} -n {item_namespace}; echo "Redeploy complete"'
+    elif redeploy == 'recreate':
+        kubectl_command = f'echo "Delete first"; kubectl delete {yaml_kind} {item_name} -n {item_namespace}; echo "Deletion Occured"; kubectl apply -f -; echo "Redeploy complete"'
+    else:
+        kubectl_command = f'kubectl {state} -f -'
+    job_manifest = apply_job_manifest(jobname, f'cat {yaml_file} | sed "s#pull_ghcr_image_token#{pull_ghcr_image_token}#g" | sed "s#image_url_var#{image_url_var}#g" | {{ {kubectl_command}; }}')
+
     namespace = "admin"
 
     try:
         api_instance.create_namespaced_job(namespace, body=job_manifest)
-        print("Job created successfully.")
+        inc_counter('doris_apply_jobs_total', mode='single')
+        logger.info('Job created successfully.')
     except Exception as e:
-        print(f"Error creating Job: {str(e)}")
-    with open(str('/' + yaml_file), 'r') as file:
-        try:
-            yaml_data = yaml.safe_load(file)
-            item_name = yaml_data.get('metadata', {}).get('name', None)
-            item_namespace = yaml_data.get('metadata', {}).get('namespace', None)
-            print(item_name)
-            print(item_namespace)
-            pods_status(item_name, item_namespace)
-        except ComposerError as e:
-                print(f"YAML parsing error: {e}. Remove --- or multiple yaml components")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-        except MarkedYAMLError as e:
-            print("YAML parsing error")
+        logger.error('Error creating Job: %s', e)
+
+
+# With job-batch-mode every runyaml call between start_apply_batch() and run_apply_batch() is added to one
+# runner Job instead of getting a Job of its own. The runner runs the actions in the order they were added
+# and prints a 'doris-result <exit code> <file>' line for each one, which is read back from its log
+apply_batch = None
+
+
+def start_apply_batch():
+    global apply_batch
+    if apply_engine == 'job' and job_batch_mode:
+        apply_batch = []
+
+def delete_stub_command(documents):
+    # kubectl command deleting the objects of the documents, given just their kind, name and namespace
+    delete_manifest = ''
+    for document in documents:
+        if document.error is None:
+            stub_metadata = {key: value for key, value in (('name', document.name), ('namespace', document.namespace)) if value}
+            delete_manifest += yaml.safe_dump({'apiVersion': document.data.get('apiVersion'), 'kind': document.kind, 'metadata': stub_metadata}) + '---\n'
+    encoded_manifest = base64.b64encode(delete_manifest.encode()).decode()
+    return f'echo {encoded_manifest} | base64 -d | kubectl delete --ignore-not-found -f -'
+
+def batch_action_command(image_url_var, yaml_file, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace, force=False):
+    if state == 'delete':
+        # the file is gone from the pvc by the time the runner starts, so only what's needed to delete it is passed in
+        documents = load_manifest(yaml_file)
+        print_manifest_errors(documents)
+        if not any(document.error is None for document in documents):
+            raise ValueError(f'No Kubernetes objects to delete in {yaml_file}')
+        return delete_stub_command(documents)
 
-    print('Finished job')
+    pull_ghcr_image_token = os.getenv('pull-ghcr-image-token')
+    command = f'set -o pipefail; cat /{yaml_file.lstrip("/")} | sed "s#pull_ghcr_image_token#{pull_ghcr_image_token}#g" | sed "s#image_url_var#{image_url_var}#g" | kubectl apply -f -'
+    redeploy = redeploy_method(yaml_kind) if delete_and_deploy_flag else 'apply'
+    if redeploy == 'rolling' and force: #otherwise the apply has already started a rollout
+        command += f' && kubectl rollout restart {yaml_kind} {item_name} -n {item_namespace}'
+    elif redeploy == 'recreate':
+        command = f'kubectl delete {yaml_kind} {item_name} -n {item_namespace} --ignore-not-found; ' + command
+    return command
+
+def add_to_apply_batch(image_url_var, yaml_file, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace, rendered_hash=None, force=False):
+    try:
+        command = batch_action_command(image_url_var, yaml_file, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace, force)
+    except Exception as e:
+        logger.error('Error adding %s to the apply batch: %s', yaml_file, e)
+        return
+    apply_batch.append({'file': yaml_file, 'state': state, 'command': command, 'hash': rendered_hash})
+    logger.debug('%s added to the apply batch', yaml_file)
+
+def wait_for_job(jobname, timeout):
+    # returns True if the Job completed, False if it failed or the timeout was reached
+    batch_v1 = get_batch_v1_api()
+    job_watch = watch.Watch()
+    try:
+        for event in job_watch.stream(batch_v1.list_namespaced_job, 'admin', field_selector=f'metadata.name={jobname}', timeout_seconds=timeout):
+            job_status = event['object'].status
+            if job_status.succeeded:
+                return True
+            if job_status.failed:
+                return False
+    finally:
+        job_watch.stop()
+    logger.warning('Timed out after %ss waiting for Job %s', timeout, jobname)
+    return False
+
+def read_job_results(jobname):
+    # exit code of every file from the runner log, keyed by file
+    v1 = get_core_v1_api()
+    batch_results = {}
+    for pod in v1.list_namespaced_pod('admin', label_selector=f'job-name={jobname}').items:
+        for log_line in v1.read_namespaced_pod_log(pod.metadata.name, 'admin').splitlines():
+            if log_line.startswith('doris-result '):
+                exit_code, yaml_file = log_line[len('doris-result '):].split(' ', 1)
+                batch_results[yaml_file] = int(exit_code)
+    return batch_results
+
+def run_apply_batch(batch_name):
+    # runs the collected batch in one Job and waits for it. Returns the result of every action and the
+    # readiness futures of the workloads that were applied
+    global apply_batch
+    batch, apply_batch = apply_batch, None
+    if not batch:
+        return [], []
+
+    jobname = f'doris-{batch_name}-' + ''.join(random.choices(string.ascii_lowercase, k=5))
+    script = '\n'.join(f'( {action["command"]} ); echo "doris-result $? {action["file"]}"' for action in batch)
+    try:
+        get_batch_v1_api().create_namespaced_job('admin', body=apply_job_manifest(jobname, script, backoff_limit=0))
+        inc_counter('doris_apply_jobs_total', mode='batch')
+        logger.info('Job %s created for %s files', jobname, len(batch))
+        wait_for_job(jobname, job_batch_timeout)
+        job_results = read_job_results(jobname)
+    except Exception as e:
+        logger.error('Error running Job %s: %s', jobname, e)
+        job_results = {}
+
+    batch_results = []
+    readiness_futures = []
+    for action in batch:
+        exit_code = job_results.get(action['file'])
+        batch_results.append({'file': action['file'], 'state': action['state'], 'exit_code': exit_code, 'ok': exit_code == 0})
+        inc_counter('doris_manifest_operations_total', operation=action['state'], result='ok' if exit_code == 0 else 'error')
+        if exit_code == 0:
+            logger.info('%s %s succeeded', action['state'], action['file'])
+            if action['hash'] is not None:
+                manifest_hashes[manifest_key(action['file'])] = action['hash']
+            if action['state'] != 'delete':
+                readiness_futures.append(watch_readiness(manifest_index['files'].get(manifest_key(action['file']))))
+        else:
+            logger.warning('%s %s failed with exit code %s', action['state'], action['file'], exit_code)
+    return batch_results, readiness_futures
     
 
-# Function to count occurrences of the string "sha" in a list of dictionaries
-def count_occurrences(data_list, target_string):
-    count = 0
-    for item in data_list:
-        if isinstance(item, dict):
-            for key in item.keys():
-                if isinstance(key, str) and target_string in key:
-                    count += 1
-    return count
-
-# Function to count occurrences of 'filename'
-def count_filename_occurrences(data):
-    count = 0
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if key == "filename":
-                count += 1
-            elif isinstance(value, (dict, list)):
-                count += count_filename_occurrences(value)
-    elif isinstance(data, list):
-        for item in data:
-            count += count_filename_occurrences(item)
-    return count
-
-def status_check_and_run(file_status, directory, deploy_after_clone):
+# git diff change types as the statuses the GitHub commits API uses
+git_change_statuses = {'A': 'added', 'C': 'added', 'D': 'removed', 'M': 'modified', 'T': 'modified', 'R': 'renamed'}
+
+def local_commit_files(previous_commit_sha, commit_sha):
+    # changed files between two commits from the clone on the pvc, in the shape of the "files" list of the
+    # GitHub commits API. Renames are detected by git (-M)
+    repo = get_yaml_repo(fetch=False)
+    commit_files = []
+    for diff in repo.commit(previous_commit_sha).diff(commit_sha, M=True):
+        file_status = git_change_statuses.get(diff.change_type[0], 'changed')
+        if file_status == 'removed':
+            commit_files.append({'filename': diff.a_path, 'status': file_status})
+        elif file_status == 'renamed':
+            commit_files.append({'filename': diff.b_path, 'status': file_status, 'previous_filename': diff.a_path})
+        else:
+            commit_files.append({'filename': diff.b_path, 'status': file_status})
+    return commit_files
+
+def commit_changed_files(previous_commit_sha, commit_sha, token, squash=False):
+    # falls back to the GitHub API if the commits aren't in the local clone. With squash the commits in
+    # between are compared as a whole rather than commit_sha being one commit on from previous_commit_sha
+    try:
+        commit_files = local_commit_files(previous_commit_sha, commit_sha)
+        logger.debug('%s files changed in %s according to the local repo', len(commit_files), commit_sha)
+        return commit_files
+    except Exception as e:
+        logger.warning('Could not diff %s..%s locally, asking GitHub instead: %s', previous_commit_sha, commit_sha, e)
+    if squash:
+        url = str(f"{github_api_url}/repos/{user_account}/{repo_name}/compare/{previous_commit_sha}...{commit_sha}")
+    else:
+        url = str(f"{github_api_url}/repos/{user_account}/{repo_name}/commits/" + commit_sha)
+    json_data, modified = github_get(url, token)
+    return json_data.get("files", [])
+
+def split_renamed_files(commit_files):
+    # a file renamed into or out of the deploy folder (or from or to a name not in the deploy format) is handled as
+    # adding or removing it. Renames within the deploy folder are kept, so their objects are updated in place
+    # rather than deleted and created again
+    split_files = []
+    for file_entry in commit_files:
+        if file_entry.get("status") == "renamed" and file_entry.get("previous_filename") and (
+                parse_changed_file(file_entry) is None or parse_changed_file({'filename': file_entry["previous_filename"]}) is None):
+            split_files.append({'filename': file_entry["previous_filename"], 'status': 'removed'})
+            split_files.append({'filename': file_entry["filename"], 'status': 'added'})
+        else:
+            split_files.append(file_entry)
+    return split_files
+
+class ChangedFile:
+    # one file in the deploy folder changed by a commit, <folder order>-<folder>/<file order>-<file>
+    __slots__ = ('folder_order', 'folder', 'file_order', 'file', 'status', 'directory', 'previous_directory')
+
+    def __init__(self, folder_order, folder, file_order, file, status, directory, previous_directory=None):
+        self.folder_order = folder_order
+        self.folder = folder
+        self.file_order = file_order
+        self.file = file
+        self.status = status
+        self.directory = directory #path from the deploy folder
+        self.previous_directory = previous_directory #path before the file was renamed
+
+    def sort_key(self):
+        return (self.folder_order, self.file_order)
+
+    def __repr__(self):
+        return f'ChangedFile({self.status} {self.directory})'
+
+def parse_changed_file(file_entry):
+    # None if the file isn't a deploy file named in the right format
+    filename = file_entry.get("filename") or ''
+    if not filename.startswith(f'{folder_name}/'):
+        logger.debug('%s is not in the %s folder and so not included', filename, folder_name)
+        return None
+    directory = filename[len(f'{folder_name}/'):]
+    split_directory = directory.split('/')
+    if len(split_directory) != 2:
+        logger.debug('No / in directory %s and so not included', directory)
+        return None
+    folder_order, _, folder = split_directory[0].partition('-')
+    file_order, _, file = split_directory[1].partition('-')
+    if not folder or not folder_order.isdigit():
+        logger.warning('folder name in %s not in correct format', directory)
+        return None
+    if not file or not file_order.isdigit():
+        logger.warning('file name in %s not in correct format', directory)
+        return None
+    previous_directory = None
+    if file_entry.get("status") == "renamed" and (file_entry.get("previous_filename") or '').startswith(f'{folder_name}/'):
+        previous_directory = file_entry["previous_filename"][len(f'{folder_name}/'):]
+    return ChangedFile(int(folder_order), folder, int(file_order), file, file_entry.get("status"), directory, previous_directory)
+
+def parse_changed_files(commit_files):
+    changed_files = []
+    for file_entry in commit_files:
+        changed_file = parse_changed_file(file_entry)
+        if changed_file is not None:
+            changed_files.append(changed_file)
+    return changed_files
+
+def sort_changed_files(changed_files):
+    # deployment order, by folder number then file number
+    return sorted(changed_files, key=ChangedFile.sort_key)
+
+def dispatch_changed_files(changed_files, deploy_after_clone, renamed_files=None):
+    for changed_file in changed_files:
+        status_check_and_run(changed_file.status, changed_file.directory, deploy_after_clone, changed_file.previous_directory, renamed_files)
+
+def status_check_and_run(file_status, directory, deploy_after_clone, previous_directory=None, renamed_files=None):
     last_hyphen_index = directory.rfind('-')
     if last_hyphen_index != -1:
         job_name = directory[last_hyphen_index + 1: -4]  # -4 to exclude '.yml'
-        print(job_name)
+        logger.debug('%s', job_name)
     else:
-        print("No hyphen found.")
+        logger.debug('No hyphen found.')
         job_name = ''.join(random.choices(string.ascii_letters, k=5))
     
     yaml_file_name_link = f'{pvc_name}/{repo_name}/{folder_name}/' + directory
-    print('yaml_file_name_link is : ', yaml_file_name_link)
+    logger.debug('yaml_file_name_link is : %s', yaml_file_name_link)
 
     if file_status in {"added"}:
-        print('added')
+        logger.debug('added')
         deploy_after_clone.append(directory)
 
     elif file_status=="removed":
@@ -442,106 +1727,146 @@ def status_check_and_run(file_status, directory, deploy_after_clone):
             item_name = "empty"
             item_namespace = "empty"
             runyaml(job_name, image_url_var_str, yaml_file_name_link, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace)
-            print('removed')
+            logger.debug('removed')
         else:
-            print("Tried to delete pipeline initialisation process. Please add this file back into repo: ", directory)
+            logger.warning('Tried to delete pipeline initialisation process. Please add this file back into repo: %s', directory)
         
     elif file_status in {"modified", "changed"}:
-        print('modified')
+        logger.debug('modified')
         deploy_after_clone.append(directory)
 
-    elif file_status in {"renamed", "copied", "unchanged"}:
-        print(f'File status {file_status} not supported')
-
-
-def extract_volumes(yaml_data):
-    volumes = []
-    if isinstance(yaml_data, dict):
-        if 'volumes' in yaml_data:
-            volumes.extend(yaml_data['volumes'])
-        for value in yaml_data.values():
-            volumes.extend(extract_volumes(value))
-    elif isinstance(yaml_data, list):
-        for item in yaml_data:
-            volumes.extend(extract_volumes(item))
-    return volumes
-
-def extract_spec(yaml_data):
-    specs = []
-    if isinstance(yaml_data, dict):
-        yaml_data = yaml_data.get('template', {})
-        if 'spec' in yaml_data:
-            specs.extend(yaml_data['spec'])
-        for value in yaml_data.values():
-            specs.extend(extract_spec(value))
-    elif isinstance(yaml_data, list):
-        for item in yaml_data:
-            specs.extend(extract_spec(item))
-    return specs
+    elif file_status == "renamed" and previous_directory is not None and renamed_files is not None:
+        # applied under its new name, then only the objects the new file no longer has are deleted. The old
+        # file is still on the pvc until the new commit is checked out
+        logger.debug('renamed from %s', previous_directory)
+        deploy_after_clone.append(directory)
+        previous_file_link = f'{pvc_name}/{repo_name}/{folder_name}/' + previous_directory
+        previous_documents = [document for document in load_manifest(previous_file_link) if document.error is None]
+        renamed_files.append((previous_file_link, yaml_file_name_link, previous_documents))
 
-def yamlcommitsha():
+    elif file_status in {"renamed", "copied", "unchanged"}:
+        logger.warning('File status %s not supported', file_status)
+
+def delete_documents(jobname, yaml_file, documents):
+    # deletes the objects of some of the documents of a file, with the same engine runyaml would use
+    if apply_batch is not None:
+        apply_batch.append({'file': yaml_file, 'state': 'delete', 'command': delete_stub_command(documents), 'hash': None})
+        return
+    if apply_engine == 'server-side':
+        for document in documents:
+            try:
+                resource = get_manifest_resource(document.data)
+                namespace = (document.namespace or 'admin') if resource.namespaced else None
+                action = 'deleted' if delete_resource(resource, document.name, namespace, wait=False) else 'not found'
+                inc_counter('doris_manifest_operations_total', operation=action, result='ok')
+                logger.info('%s %s %s', document.kind, document.name, action)
+            except Exception as e:
+                inc_counter('doris_manifest_operations_total', operation='delete', result='error')
+                logger.error('Error deleting %s %s from %s: %s', document.kind, document.name, yaml_file, e)
+        return
+    try:
+        get_batch_v1_api().create_namespaced_job('admin', body=apply_job_manifest(jobname, delete_stub_command(documents)))
+        inc_counter('doris_apply_jobs_total', mode='single')
+        logger.info('Job created successfully.')
+    except Exception as e:
+        logger.error('Error creating Job: %s', e)
+
+def delete_renamed_objects(previous_file_link, yaml_file_name_link, previous_documents):
+    # objects of a renamed file that aren't in it any more, matched by kind, namespace and name
+    object_keys = {(document.kind, document.namespace, document.name) for document in load_manifest(yaml_file_name_link) if document.error is None}
+    stale_documents = []
+    for document in previous_documents:
+        if (document.kind, document.namespace, document.name) in object_keys:
+            continue
+        if is_controller_document(document):
+            logger.warning('Not deleting %s %s of the pipeline initialisation process, removed from %s', document.kind, document.name, previous_file_link)
+            continue
+        stale_documents.append(document)
+    if stale_documents:
+        logger.info('Deleting %s objects no longer in %s, renamed from %s', len(stale_documents), yaml_file_name_link, previous_file_link)
+        jobname = ''.join(random.choices(string.ascii_lowercase, k=5)) + '-renamed'
+        delete_documents(jobname, previous_file_link, stale_documents)
+
+
+def group_deploy_waves(deploy_items):
+    # deploy items start with their (folder number, file number) and every distinct pair is one wave,
+    # returned in numeric order
+    waves = {}
+    for deploy_item in deploy_items:
+        waves.setdefault(deploy_item[:2], []).append(deploy_item)
+    return [waves[wave_order] for wave_order in sorted(waves)]
+
+def run_deploy_waves(waves, deploy_item):
+    # files in a wave are applied at the same time, up to deploy-concurrency at once, and the next wave
+    # waits for them to be ready. deploy_item applies one item and returns its readiness future
+    for wave in waves:
+        logger.info('Deploying wave %s-%s with %s files', wave[0][0], wave[0][1], len(wave))
+        if apply_batch is not None or len(wave) == 1 or deploy_concurrency <= 1:
+            #the runner Job applies files one after another anyway
+            readiness_futures = [deploy_item(item) for item in wave]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(deploy_concurrency, len(wave)), thread_name_prefix='deploy') as executor:
+                readiness_futures = list(executor.map(deploy_item, wave))
+        wait_for_readiness(readiness_futures)
 
-    # try to read configmap for commit sha. Mark as empty if cannot be found.
-    previous_commit_sha_key_value = get_configmap_data('current-yaml-commit-sha')
-    if previous_commit_sha_key_value == None:
-        previous_commit_sha = apply_configmap('current-yaml-commit-sha', 'yaml-sha', 'empty')
-        print('Created initial previous commit sha')
-    else:
-        print('Configmap already created')
+def yamlcommitsha(reconcile_state, package_images):
 
-    url = f"https://api.github.com/repos/{user_account}/{repo_name}/commits"
+    # returns whether there were new commits, and whether the commit list could be read from GitHub
+    url = f"{github_api_url}/repos/{user_account}/{repo_name}/commits?per_page=30"
 
     token = os.getenv('yaml-commit-checker-token')
 
-    headers = {
-    "Accept": "application/vnd.github+json",
-    "Authorization": f"Bearer {token}",
-    "X-GitHub-Api-Version": "2022-11-28"
-    }
+    new_commit_sha_array = np.array([])
+    new_commit_count = 0
+    synced = True
     try:
-        response = requests.request("GET", url, headers=headers)
-        json_data = json.loads(response.text)
-
-        # Count occurrences of the string "sha"
-        sha_count = count_occurrences(json_data, "sha")
-        print('Count is: ', sha_count)
-
-        new_commit_sha_array = np.array([])
-        new_commit_count = 0
-
-        previous_commit_sha_key_value = get_configmap_data('current-yaml-commit-sha')
-        print(previous_commit_sha_key_value[1])
-        if previous_commit_sha_key_value[1] == 'empty':
-            print('This is the first time and only use latest commit')
+        # state is 'empty' until the first deploy
+        logger.debug('%s', reconcile_state['yaml-sha'])
+        if reconcile_state['yaml-sha'] == 'empty':
+            logger.info('This is the first time and only use latest commit')
             use_latest_commit = True
             previous_commit_sha = 'empty'
         else:
-            previous_commit_sha = str(previous_commit_sha_key_value[1])
+            previous_commit_sha = str(reconcile_state['yaml-sha'])
             use_latest_commit = False
 
+        # newest commits come first, pages are only requested until the previous commit sha is found
+        previous_commit_found = False
+        for json_data, modified in github_pages(url, token):
+            if not modified and json_data and json_data[0]["sha"] == previous_commit_sha:
+                logger.debug('Commit list unchanged since the last check')
+                return False, True
+            for commit in json_data:
+                commit_sha = commit["sha"]
+                if commit_sha!=previous_commit_sha:
+                    new_commit_sha = np.array([commit_sha])
+                    new_commit_sha_array = np.append(new_commit_sha_array, new_commit_sha)
+                    new_commit_count += 1
+                else:
+                    logger.debug('Not a new commit')
+                    previous_commit_found = True
+                    break
+                if use_latest_commit == True:
+                    break
+            if previous_commit_found or use_latest_commit == True:
+                break
+        if not previous_commit_found and use_latest_commit == False:
+            logger.warning('Previous commit %s not found in commit history', previous_commit_sha)
+
     except Exception as e:
-        print('Error with GitHub API when trying to receive commit history')
+        logger.error('Error with GitHub API when trying to receive commit history')
+        new_commit_sha_array = np.array([])
         new_commit_count = 0
-        sha_count = 0
         use_latest_commit = False
+        synced = False
 
-    if sha_count!=0:            
-        for commit_number in range(0,sha_count):
-            commit_sha = json_data[commit_number]["sha"]
-            if commit_sha!=previous_commit_sha:
-                new_commit_sha = np.array([commit_sha])
-                new_commit_sha_array = np.append(new_commit_sha_array, new_commit_sha)
-                new_commit_count += 1
-            else:
-                print('Not a new commit')
-                break
-
+    if new_commit_count!=0:
         #this will run when no previous commit sha is detected
         if use_latest_commit == True:
-            print('Only using latest commit')
+            logger.debug('Only using latest commit')
             flipped_new_commit_sha_array = np.array((new_commit_sha_array[0]))
             flipped_new_commit_sha_array = flipped_new_commit_sha_array.reshape(1)
-            print('new_commit_sha_array is', flipped_new_commit_sha_array)
+            logger.debug('new_commit_sha_array is %s', flipped_new_commit_sha_array)
             cloneyamlrepo(str(new_commit_sha_array[0])) #clone repo
 
             #=================================================================================
@@ -549,21 +1874,21 @@ def yamlcommitsha():
             directory = f'/{pvc_name}/{repo_name}/{folder_name}'
 
             folders = [f for f in os.listdir(directory) if os.path.isdir(os.path.join(directory, f))]
-            print('folders are: ', folders)
+            logger.debug('folders are: %s', folders)
             folder_list_details = []
 
             for folder in folders:
-                print(folder)
+                logger.debug('%s', folder)
                 try:
                     order, command_foldername = folder.split('-')
                     combined_array = np.array([int(order), folder])
                     folder_list_details.append(combined_array)
                 except ValueError:
-                    print('File name did not contain a dash')
+                    logger.debug('File name did not contain a dash')
 
             # Stack the arrays vertically
             folder_list_separated = np.vstack(folder_list_details)
-            print('folder_list_separated: ', folder_list_separated)
+            logger.debug('folder_list_separated: %s', folder_list_separated)
             # Convert the first column to integers for sorting
             first_folder_column = folder_list_separated[:, 0].astype(int)
 
@@ -574,353 +1899,354 @@ def yamlcommitsha():
             sorted_folder_list = folder_list_separated[sorted_folder_indices]
 
             # print('sorted_folder_list :', sorted_folder_list)
-            print('folder list has been sorted')
+            logger.debug('folder list has been sorted')
 
             #=================================================================================
             #sort files
+            start_apply_batch() #with job-batch-mode the whole initial deploy runs in one Job
+            deploy_items = []
             for folder_row in sorted_folder_list:
-                print('folder row is :', folder_row)
+                logger.debug('folder row is : %s', folder_row)
                 directory = f'/{pvc_name}/{repo_name}/{folder_name}/'+str(folder_row[1])
                 file_list = os.listdir(directory)
-                file_list_details = []
-                print('file_list :', file_list)
+                logger.debug('file_list : %s', file_list)
 
                 for file in file_list:
                     try:
                         order, command_filename = file.split('-')
-                        combined_array = np.array([int(order), file])
-                        file_list_details.append(combined_array)
+                        yaml_file_name_link = f'{pvc_name}/{repo_name}/{folder_name}/' + str(folder_row[1]) + '/' + str(file)
+                        deploy_items.append((int(folder_row[0]), int(order), file, yaml_file_name_link))
                     except ValueError:
-                        print('File name did not contain a dash')
-
-                # Stack the arrays vertically
-                file_list_separated = np.vstack(file_list_details)
-                print('file_list_separated: ', file_list_separated)
-                # Convert the first column to integers for sorting
-                first_file_column = file_list_separated[:, 0].astype(int)
-
-                # Sort the indices based on the first column
-                sorted_file_indices = np.argsort(first_file_column)
-
-                # Apply the sorted indices to the array
-                sorted_file_list = file_list_separated[sorted_file_indices]
-
-                print('sorted_file_list :', sorted_file_list)
-
-                for row in sorted_file_list:
-                    yaml_file_name = row[1]
-                    job_name = str(os.path.splitext(yaml_file_name)[0])
-                    print('Job name is: ', job_name)
-                    yaml_file_name_link = f'{pvc_name}/{repo_name}/{folder_name}/' + str(folder_row[1]) + '/' + str(yaml_file_name)
-                    print('yaml_file_name_link is : ', yaml_file_name_link)
-
-                    # does yaml file name (main bit) match any of the container names?
-                    configmaplist = get_configmaps()
-                    for package_name_value in configmaplist:
-                        package_name_value_strip = str(package_name_value).split('-')[1]
-                        if package_name_value_strip in job_name:
-                            key_and_value = get_configmap_data(package_name_value)
-                            image_url_var_str = key_and_value[1]
-                            print('Importing custom image url')
-                            print('Image url is', image_url_var_str)
-                            break
-                        else:
-                            image_url_var_str="default"
-                            print('Standard package deployment')
-
-                    delete_and_deploy_flag = False
-                    yaml_kind = "empty"
-                    item_name = "empty"
-                    item_namespace = "empty"
-                    runyaml(job_name, image_url_var_str, yaml_file_name_link, 'apply', delete_and_deploy_flag, yaml_kind, item_name, item_namespace)
-                    print(f"Applying {yaml_file_name}")
-                    # time.sleep(10) #I don't like this, but would have to pull info from yaml file to query pod status. Future enhancement
-            update_configmap('current-yaml-commit-sha', 'yaml-sha', str(new_commit_sha_array[0]))
-            print('Initial configmap for yaml sha applied')
+                        logger.debug('File name did not contain a dash')
+
+            def deploy_initial_file(deploy_item):
+                folder_order, file_order, yaml_file_name, yaml_file_name_link = deploy_item
+                job_name = str(os.path.splitext(yaml_file_name)[0])
+                logger.debug('Job name is: %s', job_name)
+                logger.debug('yaml_file_name_link is : %s', yaml_file_name_link)
+
+                image_url_var_str = resolve_image_url(yaml_file_name_link, package_images)
+
+                delete_and_deploy_flag = False
+                yaml_kind = "empty"
+                item_name = "empty"
+                item_namespace = "empty"
+                logger.debug('Applying %s', yaml_file_name)
+                return runyaml(job_name, image_url_var_str, yaml_file_name_link, 'apply', delete_and_deploy_flag, yaml_kind, item_name, item_namespace)
+
+            run_deploy_waves(group_deploy_waves(deploy_items), deploy_initial_file)
+            batch_results, readiness_futures = run_apply_batch('initial')
+            wait_for_readiness(readiness_futures)
+            reconcile_state['yaml-sha'] = str(new_commit_sha_array[0])
+            logger.info('Initial yaml sha recorded')
 
     #this will run when previous commit sha is detected
         else:
-            print('Using all new commits')
+            logger.debug('Using all new commits')
             flipped_new_commit_sha_array = np.flipud(new_commit_sha_array) #so that we're executing the oldest changes first
-            print('flipped_new_commit_sha_array is: ', flipped_new_commit_sha_array)
-            print('new_commit_count is: ', new_commit_count)
+            logger.debug('flipped_new_commit_sha_array is: %s', flipped_new_commit_sha_array)
+            logger.debug('new_commit_count is: %s', new_commit_count)
+            squash_commits = commit_replay_mode == 'squash' and len(flipped_new_commit_sha_array) > 1
+            if squash_commits:
+                # only the net change from the last applied commit to the newest one is applied, so a file
+                # changed in several commits is deployed once at its final version
+                logger.info('Squashing %s commits into %s', len(flipped_new_commit_sha_array), new_commit_sha_array[0])
+                flipped_new_commit_sha_array = flipped_new_commit_sha_array[-1:]
+
+            try:
+                get_yaml_repo() #one fetch for every new commit, which are then diffed locally
+            except Exception as e:
+                logger.error('Error fetching yaml repo: %s', e)
 
             for new_commit_reference in flipped_new_commit_sha_array:
-                print('new_commit_reference is :', new_commit_reference)
-                url = str(f"https://api.github.com/repos/{user_account}/{repo_name}/commits/" + new_commit_reference)
-
-                headers = {
-                "Accept": "application/vnd.github+json",
-                "Authorization": f"Bearer {token}",
-                "X-GitHub-Api-Version": "2022-11-28"
-                }
-
-                response = requests.request("GET", url, headers=headers)
-                json_data = json.loads(response.text)
-
-                # Count occurrences of 'filename'
-                filename_count = count_filename_occurrences(json_data)
-
-                print(f'The number of occurrences of "filename" is: {filename_count}')
-                # filename_and_status_array = np.array([])
-                filename_and_status_array_count = 0
-
-                for filename_number in range(0, filename_count):
-                    directory = json_data.get("files", [{}])[filename_number].get("filename", None)
-                    print('directory is: ', directory)
-                    if '/' in directory:
-                        directory = directory[len(f'{folder_name}/'):]
-                        split_directory = directory.split('/')
-                        
-                        folder_na = split_directory[0]
-                        if '-' in folder_na:
-                            split_folder_name = folder_na.split('-')
-                            folder_number = split_folder_name[0]
-                            only_folder_name = split_folder_name[1]
-
-                            file_name = split_directory[1]
-                            if '-' in file_name:
-                                split_file_name = file_name.split('-')
-                                file_number = split_file_name[0]
-                                only_file_name = split_file_name[1]
-
-                                filename_status = json_data.get("files", [{}])[filename_number].get("status", None)
-                                filename_and_status = np.array((folder_number, only_folder_name, file_number, only_file_name, filename_status, directory))
-                                if filename_and_status_array_count==0:
-                                    filename_and_status_array = filename_and_status
-                                    filename_and_status_array_count+=1
-                                else:
-                                    filename_and_status_array = np.vstack((filename_and_status_array, filename_and_status))
-                            else:
-                                print(f'file name in {directory} not in correct format')
-                        else:
-                            print(f'folder name in {directory} not in correct format')
+                logger.debug('new_commit_reference is : %s', new_commit_reference)
+                commit_files = split_renamed_files(commit_changed_files(reconcile_state['yaml-sha'], str(new_commit_reference), token, squash_commits))
+                logger.info('%s files changed in %s', len(commit_files), new_commit_reference)
+
+                start_apply_batch() #with job-batch-mode everything in this commit runs in one Job
+                deploy_after_clone = []
+                renamed_files = []
+                dispatch_changed_files(sort_changed_files(parse_changed_files(commit_files)), deploy_after_clone, renamed_files)
+
+                logger.debug('deploy_after_clone array is: %s', deploy_after_clone)
+                logger.debug('new_commit_reference is: %s', new_commit_reference)
+
+                changed_files = []
+                for file_entry in commit_files:
+                    changed_files.append(file_entry.get("filename"))
+                    if file_entry.get("previous_filename"):
+                        changed_files.append(file_entry.get("previous_filename"))
+
+                logger.debug('Cloning new repo')
+                cloneyamlrepo(str(new_commit_reference), changed_files, fetch=False)
+
+                reconcile_state['yaml-sha'] = str(new_commit_reference)
+
+                # a renamed file keeps the hash it was last applied with, so it is only applied again if its content changed
+                for previous_file_link, yaml_file_name_link, previous_documents in renamed_files:
+                    previous_hash = manifest_hashes.pop(manifest_key(previous_file_link), None)
+                    if previous_hash is not None:
+                        manifest_hashes[manifest_key(yaml_file_name_link)] = previous_hash
+
+                readiness_futures = []
+                # files deployed in this commit don't need redeploying again for a changed configmap/secret
+                redeployed_files = {f'/{pvc_name}/{repo_name}/{folder_name}/' + str(file_to_deploy) for file_to_deploy in deploy_after_clone}
+                for file_to_deploy in deploy_after_clone:
+                    logger.debug('%s', file_to_deploy)
+                    last_hyphen_index = file_to_deploy.rfind('-')
+                    if last_hyphen_index != -1:
+                        job_name = str(''.join(random.choices(string.ascii_lowercase, k=5)) + '-' + file_to_deploy[last_hyphen_index + 1: -4])  # -4 to exclude '.yml' , got to add random letters as otherwise job name is repeated
+                        logger.debug('%s', job_name)
                     else:
-                        print(f'No / in directory {directory} and so not included')
-                    
-                if 'filename_and_status_array' not in locals():
-                    filename_and_status_array = np.empty((0, 6), dtype=str)
-                else:
-                    print('Array already created')
-                    print(filename_and_status_array)
-                    deploy_after_clone = []
-                    if filename_and_status_array.ndim <= 1:
-                        filesorted_filename_and_status_array = filename_and_status_array
-                        file_status = filesorted_filename_and_status_array[4]
-                        directory = filesorted_filename_and_status_array[5]
-                        status_check_and_run(file_status, directory, deploy_after_clone)
-                    else:
-                        folder_number_column = filename_and_status_array[:, 0]
-                        sort_folder_number_column = np.argsort(folder_number_column)
-                        foldersorted_filename_and_status_array = filename_and_status_array[sort_folder_number_column]
-                        # print(foldersorted_filename_and_status_array)
-
-                        sort_by_file_number = np.lexsort((foldersorted_filename_and_status_array[:, 2].astype(int), foldersorted_filename_and_status_array[:, 0].astype(int)))
-                        filesorted_filename_and_status_array  = foldersorted_filename_and_status_array[sort_by_file_number]
-                        print(filesorted_filename_and_status_array)
-
-                        # find number of rows in above array
-                        num_files_to_handle = filesorted_filename_and_status_array.shape[0]
-
-                        for changed_file_num in range(0, num_files_to_handle):
-                            file_status = filesorted_filename_and_status_array[changed_file_num, 4]
-                            directory = filesorted_filename_and_status_array[changed_file_num, 5]
-                            status_check_and_run(file_status, directory, deploy_after_clone)
-                    
-                    print("deploy_after_clone array is: ", deploy_after_clone)
-                    print("new_commit_reference is: ", new_commit_reference)
-                
-                    print('Cloning new repo')
-                    cloneyamlrepo(str(new_commit_reference))
-                    
-                    update_configmap('current-yaml-commit-sha', 'yaml-sha', new_commit_reference)
-
-                
-                    for file_to_deploy in deploy_after_clone:
-                        print(file_to_deploy)
-                        last_hyphen_index = file_to_deploy.rfind('-')
-                        if last_hyphen_index != -1:
-                            job_name = str(''.join(random.choices(string.ascii_lowercase, k=5)) + '-' + file_to_deploy[last_hyphen_index + 1: -4])  # -4 to exclude '.yml' , got to add random letters as otherwise job name is repeated
-                            print(job_name)
-                        else:
-                            print("No hyphen found.")
-                            job_name = ''.join(random.choices(string.ascii_lowercase, k=5))
-                        yaml_file_name_link = f'{pvc_name}/{repo_name}/{folder_name}/' + str(file_to_deploy)
-                        print('yaml_file_name_link is : ', yaml_file_name_link)
-                        
-                        # does yaml file name (main bit) match any of the container names?
-                        configmaplist = get_configmaps()
-                        for package_name_value in configmaplist:
-                            package_name_value_strip = str(package_name_value).split('-')[1]
-                            if package_name_value_strip in job_name:
-                                key_and_value = get_configmap_data(package_name_value)
-                                image_url_var_str = key_and_value[1]
-                                print('Importing custom image url')
-                                print('Image url is', image_url_var_str)
-                                break
-                            else:
-                                image_url_var_str="default"
-                                print('Standard package deployment')
-
-                        state='apply'
-                        if "pod" or "job" or "deployment" or "cronjob" or "replicaset" or  "statefulset" or  "daemonset" in job_name:
+                        logger.debug('No hyphen found.')
+                        job_name = ''.join(random.choices(string.ascii_lowercase, k=5))
+                    yaml_file_name_link = f'{pvc_name}/{repo_name}/{folder_name}/' + str(file_to_deploy)
+                    logger.debug('yaml_file_name_link is : %s', yaml_file_name_link)
+
+                    image_url_var_str = resolve_image_url(yaml_file_name_link, package_images)
+
+                    state='apply'
+                    logger.debug('Determining kinds and names for %s', job_name)
+                    documents = load_manifest(yaml_file_name_link)
+                    print_manifest_errors(documents)
+                    document = primary_document(documents)
+                    if document is None:
+                        logger.warning('No Kubernetes objects in %s', file_to_deploy)
+                        continue
+                    yaml_kind, item_name, item_namespace = document.kind, document.name, document.namespace
+                    # changed workloads are restarted, how depends on redeploy_method()
+                    delete_and_deploy_flag = yaml_kind in workload_kinds
+                    logger.debug('%s %s %s', yaml_kind, item_name, item_namespace)
+                    changed_configs = sorted({(document.kind, document.name) for document in documents if document.kind in ('ConfigMap', 'Secret')})
+                    config_changed = bool(changed_configs) and not manifest_is_applied(yaml_file_name_link, image_url_var_str)
+                    readiness_futures.append(runyaml(job_name, image_url_var_str, yaml_file_name_link, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace))
+                    logger.debug('Applying %s', file_to_deploy)
+
+                    # redeploy the workloads that use a changed configmap or secret so they pick up the new configuration
+                    if config_changed:
+                        logger.info('Updating corresponding app for configmap/secret')
+                        consumer_files = []
+                        for config_kind, config_name in changed_configs:
+                            for file_in_search in lookup_manifests(config_ref=(config_kind, config_name)):
+                                if file_in_search not in redeployed_files:
+                                    redeployed_files.add(file_in_search)
+                                    logger.info('%s %s is used by %s', config_kind, config_name, file_in_search)
+                                    consumer_files.append(file_in_search)
+                        for file_in_search in consumer_files:
+                            consumer_document = primary_document(manifest_index['files'][file_in_search])
                             delete_and_deploy_flag = True
-                            print(f'Determining kinds and names for {job_name}')
-                            with open(str('/' + yaml_file_name_link), 'r') as file:
-                                try:
-                                    yaml_data = yaml.safe_load(file)
-                                    item_name = yaml_data.get('metadata', {}).get('name', None)
-                                    item_namespace = yaml_data.get('metadata', {}).get('namespace', None)
-                                except ComposerError as e:
-                                    print(f"YAML parsing error: {e}. Remove --- or multiple yaml components")
-                                    break
-                                except Exception as e:
-                                    print(f"An unexpected error occurred: {e}")
-                                    break
-                                except MarkedYAMLError as e:
-                                    break
-                                    print("YAML parsing error")
-                            if "pod" in job_name:
-                                yaml_kind = "pod"
-                            elif "job" in job_name:
-                                yaml_kind = "job"
-                            elif "deployment" in job_name:
-                                yaml_kind = "deployment"
-                            elif "cronjob" in job_name:
-                                yaml_kind = "cronjob"
-                            elif "replicaset" in job_name:
-                                yaml_kind = "replicaset"
-                            elif "statefulset" in job_name:
-                                yaml_kind = "statefulset"
-                            else:
-                                yaml_kind = "daemonset"
-                            
-                        else:
-                            delete_and_deploy_flag = False
-                        print(yaml_kind, item_name, item_namespace)
-                        runyaml(job_name, image_url_var_str, yaml_file_name_link, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace)
-                        print(f"Applying {file_to_deploy}")
-
-                        if "configmap" or "secret" in job_name:
-                            print('Updating corresponding app for configmap/secret')
-                            with open(str('/' + yaml_file_name_link), 'r') as file:
-                                try:
-                                    yaml_data = yaml.safe_load(file)
-                                    item_name = yaml_data.get('metadata', {}).get('name', None)
-                                except ComposerError as e:
-                                    print(f"YAML parsing error: {e}. Remove --- or multiple yaml components")
-                                    break
-                                except Exception as e:
-                                    print(f"An unexpected error occurred: {e}")
-                                except MarkedYAMLError as e:
-                                    print("YAML parsing error")
-
-                                file_in_search_array = []
-                                for foldername, subfolders, filenames in os.walk(f'/{pvc_name}/{repo_name}/{folder_name}'):
-                                    print('Searching files for app deploy file')
-                                    for filename in filenames:
-                                        file_path = os.path.join(foldername, filename)
-                                        if "pod" or "job" or "deployment" or "cronjob" or "replicaset" or  "statefulset" or  "daemonset" in file_path:
-                                            file_in_search_array.append(file_path)
-                                        else:
-                                            print('Not image linked file')
-                            print('file_in_search_array', file_in_search_array)
-                                    
-                            # array of all files that contain pod/job/deployment name
-                            for file_in_search in file_in_search_array:
-                                print('Searching for corresponding app in', file_in_search)
-                                with open(str(file_in_search), 'r') as file: # open every file in search of configmap name
-                                    try:
-                                        yaml_data = yaml.safe_load(file)
-                                        if "configmap" in job_name:
-                                            print('If configmap then...')
-                                            volumes = extract_volumes(yaml_data)
-                                            print('volumes are:', volumes)
-                                            for volume in volumes:
-                                                print('volume is: ', volume)
-                                                print(type(volume))
-                                                print('Looking at individual volumes')
-                                                if 'configMap' in volume:
-                                                    print('configMap in volume')
-                                                    dict_part = volume.get('configMap', {})
-                                                    print('dict part is: ', dict_part)
-                                                    config_map = dict_part.get('name', '')
-                                                    print('printing configmap', config_map)
-                                                    if str(config_map) == item_name:
-                                                        print('Configmap match found')
-                                                        delete_and_deploy_flag = True
-                                                        yaml_kind = yaml_data.get('kind')
-                                                        item_name = yaml_data.get('metadata', {}).get('name', None)
-                                                        item_namespace = yaml_data.get('metadata', {}).get('namespace', None)
-                                                        last_hyphen_index = file_in_search.rfind('-')
-                                                        if last_hyphen_index != -1:
-                                                            job_name = str(''.join(random.choices(string.ascii_lowercase, k=5)) + '-' + file_in_search[last_hyphen_index + 1: -4])  # -4 to exclude '.yml' , got to add random letters as otherwise job name is repeated
-                                                            print(job_name)
-                                                        runyaml(job_name, image_url_var_str, file_in_search, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace)
-                                                    else:
-                                                        print('Searching next volume')
-                                        if "secret" in job_name:
-                                            print('If configmap then...')
-                                            volumes = extract_volumes(yaml_data)
-                                            specs = extract_spec(yaml_data)
-                                            print('volumes are:', volumes)
-                                            for volume in volumes:
-                                                print('volume is: ', volume)
-                                                print(type(volume))
-                                                print('Looking at individual volumes')
-                                                if 'secret' in volume:
-                                                    print('secret in volume')
-                                                    dict_part = volume.get('secret', {})
-                                                    print('dict part is: ', dict_part)
-                                                    secret_name = dict_part.get('secretName', '')
-                                                    print('printing configmap', secret_name)
-                                                    if str(secret_name) == item_name:
-                                                        print('Secret match found')
-                                                        delete_and_deploy_flag = True
-                                                        yaml_kind = yaml_data.get('kind')
-                                                        item_name = yaml_data.get('metadata', {}).get('name', None)
-                                                        item_namespace = yaml_data.get('metadata', {}).get('namespace', None)
-                                                        last_hyphen_index = file_in_search.rfind('-')
-                                                        if last_hyphen_index != -1:
-                                                            job_name = str(''.join(random.choices(string.ascii_lowercase, k=5)) + '-' + file_in_search[last_hyphen_index + 1: -4])  # -4 to exclude '.yml' , got to add random letters as otherwise job name is repeated
-                                                            print(job_name)
-                                                        runyaml(job_name, image_url_var_str, file_in_search, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace)
-                                                    else:
-                                                        print('Searching next volume')
-                                                elif 'imagePullSecrets' in volume:
-                                                    print('secret in volume')
-                                                    for spec in specs:
-                                                        dict_part = spec.get('imagePullSecrets', {})
-                                                        print('dict part is: ', dict_part)
-                                                        secret_name = dict_part.get('name', '')
-                                                        print('printing configmap', secret_name)
-                                                        if str(secret_name) == item_name:
-                                                            print('Secret match found')
-                                                            delete_and_deploy_flag = True
-                                                            yaml_kind = yaml_data.get('kind')
-                                                            item_name = yaml_data.get('metadata', {}).get('name', None)
-                                                            item_namespace = yaml_data.get('metadata', {}).get('namespace', None)
-                                                            last_hyphen_index = file_in_search.rfind('-')
-                                                            if last_hyphen_index != -1:
-                                                                job_name = str(''.join(random.choices(string.ascii_lowercase, k=5)) + '-' + file_in_search[last_hyphen_index + 1: -4])  # -4 to exclude '.yml' , got to add random letters as otherwise job name is repeated
-                                                                print(job_name)
-                                                            runyaml(job_name, image_url_var_str, file_in_search, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace)
-                                                        else:
-                                                            print('Searching next volume')
-                                    except ComposerError as e:
-                                        print(f"YAML parsing error: {e}. Remove --- or multiple yaml components")
-                                    except Exception as e:
-                                        print(f"An unexpected error occurred: {e}")
-                                    except MarkedYAMLError as e:
-                                        print("YAML parsing error")
-                               
-refresh_counter = 0     
-
-while True:
-    container_versions()   
-    yamlcommitsha()
-    refresh_counter+=1
-    print('refresh_counter = ', refresh_counter)
-    time.sleep(20)               
+                            yaml_kind = consumer_document.kind
+                            item_name = consumer_document.name
+                            item_namespace = consumer_document.namespace
+                            last_hyphen_index = file_in_search.rfind('-')
+                            if last_hyphen_index != -1:
+                                job_name = str(''.join(random.choices(string.ascii_lowercase, k=5)) + '-' + file_in_search[last_hyphen_index + 1: -4])  # -4 to exclude '.yml' , got to add random letters as otherwise job name is repeated
+                                logger.debug('%s', job_name)
+                            image_url_var_str = resolve_image_url(file_in_search, package_images)
+                            readiness_futures.append(runyaml(job_name, image_url_var_str, file_in_search, state, delete_and_deploy_flag, yaml_kind, item_name, item_namespace, force=True))
+
+                for previous_file_link, yaml_file_name_link, previous_documents in renamed_files:
+                    delete_renamed_objects(previous_file_link, yaml_file_name_link, previous_documents)
+
+                batch_results, batch_futures = run_apply_batch(str(new_commit_reference)[:7])
+                readiness_futures.extend(batch_futures)
+                wait_for_readiness(readiness_futures)
+
+    return new_commit_count!=0, synced
+
+# GitHub push and package webhooks can wake the loop up early and only run the affected half of the
+# reconcile: 'packages' (container_versions) or 'commits' (yamlcommitsha). Polling carries on as a safety net
+reconcile_sources = {'packages', 'commits'}
+reconcile_triggers = set()
+reconcile_trigger_lock = threading.Lock()
+reconcile_wakeup = threading.Event()
+
+# each source is polled on its own schedule. The interval drops to poll-min-interval when a check finds a
+# change and grows by poll-backoff after every quiet check up to poll-max-interval, with some jitter.
+# next_poll is measured from the start of the check so the time a cycle takes counts towards the interval
+poll_schedule = {source: {'interval': float(poll_interval), 'next_poll': 0.0} for source in reconcile_sources}
+
+
+def trigger_reconcile(source):
+    with reconcile_trigger_lock:
+        reconcile_triggers.add(source)
+    reconcile_wakeup.set()
+
+def record_poll_result(source, changed, started):
+    schedule = poll_schedule[source]
+    if changed:
+        schedule['interval'] = float(poll_min_interval)
+    else:
+        schedule['interval'] = min(schedule['interval'] * poll_backoff, float(poll_max_interval))
+    delay = schedule['interval'] * random.uniform(1 - poll_jitter, 1 + poll_jitter)
+    schedule['next_poll'] = started + delay
+    set_gauge('doris_poll_interval_seconds', schedule['interval'], source=source)
+    logger.debug('Next %s check in %.1fs (interval %.1fs)', source, delay, schedule['interval'])
+
+def due_poll_sources():
+    now = time.monotonic()
+    return {source for source, schedule in poll_schedule.items() if schedule['next_poll'] <= now}
+
+def wait_for_reconcile_trigger():
+    # returns the sources a webhook asked for plus the ones whose next poll is due
+    while True:
+        next_poll = min(schedule['next_poll'] for schedule in poll_schedule.values())
+        reconcile_wakeup.wait(max(0, next_poll - time.monotonic()))
+        with reconcile_trigger_lock:
+            triggered_sources = set(reconcile_triggers)
+            reconcile_triggers.clear()
+            reconcile_wakeup.clear()
+        sources = triggered_sources | due_poll_sources()
+        if sources:
+            return sources
+
+def verify_webhook_signature(body, signature):
+    expected_signature = 'sha256=' + hmac.new(webhook_secret.encode(), body, hashlib.sha256).hexdigest()
+    return signature is not None and hmac.compare_digest(expected_signature, signature)
+
+def webhook_event_source(event, payload):
+    # which half of the reconcile a webhook event affects, None if it isn't relevant to this cluster
+    if event == 'push':
+        repository = payload.get('repository') or {}
+        default_branch_ref = 'refs/heads/' + str(repository.get('default_branch'))
+        if repository.get('name') == repo_name and payload.get('ref') == default_branch_ref:
+            return 'commits'
+    elif event in ('package', 'registry_package'):
+        package = payload.get('package') or payload.get('registry_package') or {}
+        package_name = str(package.get('name'))
+        if package_name.startswith(custom_container_prefix+'-') or "pipelineinitialisation" in package_name:
+            return 'packages'
+    return None
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics' or str(self.server.server_address[1]) != str(metrics_port):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class WebhookHandler(MetricsHandler):
+    # also serves /metrics when metrics-port is the same as webhook-port
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not verify_webhook_signature(body, self.headers.get('X-Hub-Signature-256')):
+            logger.warning('Webhook signature did not match, ignoring request')
+            self.send_response(401)
+            self.end_headers()
+            return
+        event = self.headers.get('X-GitHub-Event')
+        try:
+            source = webhook_event_source(event, json.loads(body))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        if source is not None:
+            logger.info('Webhook %s event received, checking %s', event, source)
+            trigger_reconcile(source)
+        else:
+            logger.debug('Webhook %s event not relevant', event)
+        self.send_response(202)
+        self.end_headers()
+
+def start_webhook_server():
+    if webhook_port is None:
+        return None
+    if not webhook_secret:
+        logger.warning('webhook-secret must be set to use webhooks, only polling will be used')
+        return None
+    server = ThreadingHTTPServer(('', int(webhook_port)), WebhookHandler)
+    threading.Thread(target=server.serve_forever, name='webhooks', daemon=True).start()
+    logger.info('Listening for GitHub webhooks on port %s', webhook_port)
+    return server
+
+def start_metrics_server(webhook_server):
+    if metrics_port is None:
+        return None
+    if webhook_server is not None and str(metrics_port) == str(webhook_port):
+        logger.info('Serving metrics on the webhook port %s', metrics_port)
+        return webhook_server
+    server = ThreadingHTTPServer(('', int(metrics_port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on port %s', metrics_port)
+    return server
+
+def reconcile(sources):
+    global manifest_hashes, log_cycle_id
+    log_cycle_id = uuid.uuid4().hex[:12]
+    logger.info('Checking %s', ', '.join(sorted(sources)))
+    with timing_span('reconcile'):
+        with timing_span('read-state'):
+            reconcile_state = read_reconcile_state()
+        manifest_hashes = reconcile_state.setdefault('manifests', {})
+        package_images = build_package_images(reconcile_state)
+        try:
+            if 'packages' in sources:
+                started = time.monotonic()
+                with timing_span('packages'):
+                    changed, synced = container_versions(reconcile_state, package_images)
+                if synced:
+                    set_gauge('doris_last_successful_sync_timestamp_seconds', time.time(), source='packages')
+                record_poll_result('packages', changed, started)
+            if 'commits' in sources:
+                started = time.monotonic()
+                with timing_span('commits'):
+                    changed, synced = yamlcommitsha(reconcile_state, package_images)
+                if synced:
+                    set_gauge('doris_last_successful_sync_timestamp_seconds', time.time(), source='commits')
+                record_poll_result('commits', changed, started)
+        finally:
+            with timing_span('write-state'):
+                try:
+                    write_reconcile_state(reconcile_state)
+                except Exception:
+                    # the state still says what was deployed before, so this cycle's responses mustn't turn into 304s
+                    discard_github_cache()
+                    raise
+                save_github_cache()
+            logger.debug('Manifest cache: %s files, %s bytes, %s hits, %s misses, %s evictions', len(manifest_cache), manifest_cache_bytes, manifest_cache_stats['hits'], manifest_cache_stats['misses'], manifest_cache_stats['evictions'])
+
+
+def main():
+    refresh_counter = 0
+    setup_logging()
+    start_metrics_server(start_webhook_server())
+    sources = set(reconcile_sources)
+    while True:
+        try:
+            if profile_cycle_file and refresh_counter + 1 == profile_cycle_number:
+                # profile of one whole cycle, e.g. python -m pstats <file>
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    reconcile(sources)
+                finally:
+                    profiler.disable()
+                    profiler.dump_stats(profile_cycle_file)
+                    logger.info('Profile of cycle %s saved to %s', refresh_counter + 1, profile_cycle_file)
+            else:
+                reconcile(sources)
+        except Exception as e:
+            # e.g. the API server was unavailable, the checks are tried again at their next poll
+            logger.exception('Error during reconcile cycle: %s', e)
+            for source in sources:
+                record_poll_result(source, False, time.monotonic())
+        refresh_counter+=1
+        logger.debug('refresh_counter = %s', refresh_counter)
+        sources = wait_for_reconcile_trigger()
 
 # this last bit would need to be adapted if it were changed to a cronjob.
+
+if __name__ == '__main__':
+    main()